@@ -37,10 +37,12 @@ from lib.nano import NanoKontrol2
 import lib.util as util
 from lib.metadata import RAWWatcher
 import lib.metadata as meta
+from lib.flashstate import FlashState
 import lib.splash as splash
 import lib.exiftool as exiftool
 from lib.logger import INFO, ERROR, EXCEPTION, DEBUG, VERBOSE
 import lib.power as power
+import lib.latency as latency
 
 if sys.platform.startswith('darwin'):
     from lib.numberoverlay import NumberOverlay
@@ -98,6 +100,9 @@ class FlashControlWindow(HTMLMainWindow):
         self.nano = None
         self.lastSlider = 0
         self.delay = None
+        self.origin = None
+        self.flashState = FlashState()
+        self.seen = {}
         self.overlay = None
         self.overlayPwr = None
         self.keyhandler = KeyHandler()
@@ -125,6 +130,7 @@ class FlashControlWindow(HTMLMainWindow):
         if self.godox:
             DEBUG('Stopping godox')
             self.godox.stop()
+            latency.tracker.dump(INFO)
         if self.nano:
             DEBUG('Stopping nano')
             self.nano.stop()
@@ -191,7 +197,7 @@ class FlashControlWindow(HTMLMainWindow):
         if pid.startswith('flash-'):
             index = pid[-1:]
             VERBOSE(meta.FLASHES, self.findex(index), key, value)
-            self.config['shooting-info'][meta.FLASHES][self.findex(index)][key] = value
+            self.setFlash(index, key, value)
             self.activateGroup(index)
         else:
             VERBOSE(key, value)
@@ -213,7 +219,7 @@ class FlashControlWindow(HTMLMainWindow):
              'flash-name-', 'flash-role-', 'flash-modifier-', 'flash-accessory-', 'flash-gel-']
 
         mode = '-' if disabled else self.cv(f'save/{group_id}/mode', 'M') 
-        self.config['shooting-info'][meta.FLASHES][self.findex(group_id)][meta.MODE] = mode
+        self.setFlash(group_id, meta.MODE, mode)
         if not disabled:
             self.config['save'][group_id]['mode'] = mode
         for s in a:
@@ -239,8 +245,7 @@ class FlashControlWindow(HTMLMainWindow):
         self.powerHtml(gid)
 
     def setMode(self, group_id, v):
-        i = ord(group_id) - ord('A')
-        self.config['shooting-info'][meta.FLASHES][i][meta.MODE] = v
+        self.setFlash(group_id, meta.MODE, v)
         self.config['save'][group_id]['mode'] = v
         self.elem(f'#flash-mode-{group_id}').text = v
         self.setFlashValues()
@@ -253,7 +258,7 @@ class FlashControlWindow(HTMLMainWindow):
         return False
 
     def activateGroup(self, group_id):
-        self.onKeyPress(ENTER)
+        self.keyPress(ENTER)
         e = self.elem(f'#flash-{group_id}')
         if e:
             self.activeGroup = group_id
@@ -287,31 +292,48 @@ class FlashControlWindow(HTMLMainWindow):
         if self.delay:
             self.delay.cancel()
         self.overlayPwr = self.normalizePower(gid, pwr)
-        self.delay = Timer(0.5, self.setPower, [gid, pwr])
+        self.delay = Timer(0.5, self.setPower, [gid, pwr, self.origin])
         self.delay.start()
         if self.overlay:
             self.overlay.setValue_((self.overlayPwr, gid))
 
-    def setPower(self, group_id, power):
+    def setPower(self, group_id, power, origin = None):
         DEBUG(f'{group_id} = {power}')
         if self.overlay:
             self.overlay.hide()
             self.overlayPwr = None
         power = self.normalizePower(group_id, power)
         mode = self.cv(f'save/{group_id}/mode', 'M')
-        self.config['shooting-info'][meta.FLASHES][self.findex(group_id)]['Power'] = power
+        self.setFlash(group_id, meta.POWER, power)
         self.config['save'][group_id]['Power' + mode] = power
         self.powerHtml(group_id)
         self.power = ''
-        self.setFlashValues()
-
-    def setFlashValues(self):
+        self.setFlashValues(origin)
+
+    def setFlash(self, gid, key, value):
+        self.config['shooting-info'][meta.FLASHES][self.findex(gid)][key] = value
+        self.flashState.set(gid, key, value)
+
+    def flashChanges(self, consumer, full = False):
+        # Groups and fields changed since the consumer got them last time
+        version, changes = self.flashState.changes(0 if full else self.seen.get(consumer, 0))
+        self.seen[consumer] = version
+        return changes
+
+    def setFlashValues(self, origin = None):
+        # Input event origin is used by the first command it causes, or dropped if nothing changed
+        if origin is None:
+            origin, self.origin = self.origin, None
         if self.godox:
-            self.godox.setValues(self.config['shooting-info'][meta.FLASHES])
-        if self.metadata:
+            changes = self.flashChanges('godox')
+            if changes:
+                self.godox.setValues(changes, origin)
+        if self.metadata and self.flashChanges('metadata'):
             self.metadata.setJson(self.forExiftool(self.config['shooting-info']))
         if self.nano:
-            self.nano.setValues(self.config['shooting-info'][meta.FLASHES])
+            changes = self.flashChanges('nano')
+            if changes:
+                self.nano.setValues(changes)
 
     def powerHtml(self, gid, pwr = None):
         s = str(pwr) if pwr else str(self.pwr(gid))
@@ -327,7 +349,18 @@ class FlashControlWindow(HTMLMainWindow):
         self.elem(f'#flash-power-number{gid}').text = s
         self.elem(f'#flash-power-fnumber{gid}').text = f
 
+    def fromInput(self, handler, *args):
+        # Latency origin for flash commands issued while handling one input event
+        self.origin = latency.now()
+        try:
+            handler(*args)
+        finally:
+            self.origin = None
+
     def onKeyPress(self, key):
+        self.fromInput(self.keyPress, key)
+
+    def keyPress(self, key):
         DEBUG(f'Key pressed {key} ({chr(key) if key >= 32 else ' '})')
         manual = (self.cv(f'save/{self.activeGroup}/mode', 'M') == 'M')
         if key >= ord('0') and key <= ord('9'):
@@ -395,6 +428,8 @@ class FlashControlWindow(HTMLMainWindow):
             self.onModeClicked(None)
         elif key == ord('r'):
             self.reset(self.activeGroup)
+        elif key == ord('p'):
+            latency.tracker.dump(INFO)
 
     def onTryAgain(self, e):
         self.setPulsing('#flash-button', True)
@@ -417,7 +452,17 @@ class FlashControlWindow(HTMLMainWindow):
         self.setPulsing('#flash-button', False)
         self.elem('#flash-popup .message').text = f'Connected to: {data}'
         self.setSoundAndLight()
-        self.godox.setValues(self.config['shooting-info'][meta.FLASHES])
+        self.godox.setValues(self.flashChanges('godox', True))
+
+    def onGodoxLink(self, state):
+        if state == 'connected':
+            self.setPulsing('#flash-button', False)
+            self.elem('#flash-popup .message').text = \
+                    f'Connected to: {self.cv("godox", {}).get("name")}'
+        else:
+            self.setPulsing('#flash-button', True)
+            self.elem('#flash-popup .message').text = \
+                    'Connection lost, reconnecting...' if state == 'disconnected' else 'Reconnecting...'
 
     def onGodoxConfig(self, data):
         self.config['godox'] = data
@@ -432,7 +477,7 @@ class FlashControlWindow(HTMLMainWindow):
     def onNanoConnected(self, data):
         self.setPulsing('#nano-button', False)
         self.elem('#nano-popup .message').text = 'Connected to nanoKontrol2'
-        self.nano.setValues(self.config['shooting-info'][meta.FLASHES])
+        self.nano.setValues(self.flashChanges('nano', True))
 
     def nano2Power(self, gid, v, atype):
         defaultsS = {'M': (2.0, 10.0, 1.0), 'TTL': (-3.0, 3.0, 1.0)}
@@ -455,10 +500,16 @@ class FlashControlWindow(HTMLMainWindow):
         return pwr
 
     def onNanoSlider(self, d):
+        self.fromInput(self.nanoSlider, d)
+
+    def nanoSlider(self, d):
         v = self.nano2Power(d[0], d[1], d[2])
         self.setPowerFast(d[0], v)
 
     def onNanoEvent(self, data):
+        self.fromInput(self.nanoEvent, data)
+
+    def nanoEvent(self, data):
         gid = '-'
         if isinstance(data[0], tuple):
             gid = data[0][0]
@@ -490,7 +541,7 @@ class FlashControlWindow(HTMLMainWindow):
         mode = self.cv(f'save/{gid}/mode', 'M')
         default = '10' if mode == 'M' else '+0.0'
         pwr = self.cv(f'save/{gid}/Power{mode}', default)
-        self.config['shooting-info'][meta.FLASHES][self.findex(gid)]['Power'] = pwr
+        self.setFlash(gid, meta.POWER, pwr)
         return pwr
 
     def reset(self, gid):
@@ -501,10 +552,9 @@ class FlashControlWindow(HTMLMainWindow):
         resetSelect(f'#flash-modifier-{gid}')
         resetSelect(f'#flash-accessory-{gid}')
         resetSelect(f'#flash-gel-{gid}')
-        self.config['shooting-info'][meta.FLASHES][self.findex(gid)][meta.ROLE] = None
-        self.config['shooting-info'][meta.FLASHES][self.findex(gid)][meta.MODIFIER] = None
-        self.config['shooting-info'][meta.FLASHES][self.findex(gid)][meta.ACCESSORY] = None
-        self.config['shooting-info'][meta.FLASHES][self.findex(gid)][meta.GEL] = None
+        for key in [meta.ROLE, meta.MODIFIER, meta.ACCESSORY, meta.GEL]:
+            self.setFlash(gid, key, None)
+        self.setFlashValues()
 
     def onShowConfig(self, e):
         cfg = util.path('user/config.json')
@@ -515,10 +565,24 @@ class FlashControlWindow(HTMLMainWindow):
         if msg[1] > 0:
             self.setNotification('#meta-button', True)
 
+    def onMetadataQueue(self, depth):
+        self.elem('#meta-queue').text = f'Queue: {depth}' if depth > 0 else ''
+
     def onShowFlashPopup(self, e):
         self.setVisible('#flash-popup', True)
         self.setVisible('#close-all-popups', True)
         self.setNotification('#flash-button', False)
+        e = self.elem('#flash-latency')
+        e.empty()
+        lines = []
+        if latency.tracker.summary()['write'][0] > 0:
+            lines += latency.tracker.lines()
+        if self.godox:
+            try:
+                lines += self.godox.metrics().result(timeout = 1.0)
+            except Exception as ex:
+                ERROR(f'Godox metrics failed: {ex}')
+        e.append('<br/>'.join(lines))
 
     def onShowMetaPopup(self, e):
         self.setVisible('#meta-popup', True)
@@ -549,6 +613,9 @@ class FlashControlWindow(HTMLMainWindow):
         self.close(1)
 
     def onWheel(self, e):
+        self.fromInput(self.wheel, e)
+
+    def wheel(self, e):
         elem = self.elementFromPoint(e['clientX'], e['clientY'])
         if elem and 'id' in elem and elem['id'].startswith('flash-power-number'):
             gid = elem['id'][-1:]
@@ -580,7 +647,8 @@ class FlashControlWindow(HTMLMainWindow):
 
         if meta.FLASHES in data:
             for i, f in enumerate(data[meta.FLASHES]):
-                key = f.get(meta.ID, f.get('ID', chr(ord('A') + i)))
+                key = f.get(meta.ID, f.pop('ID', chr(ord('A') + i)))
+                f[meta.ID] = key
                 flashes[key] = f
         a = []
         for i in range(self.cv('flash-groups', 6)):
@@ -609,6 +677,7 @@ class FlashControlWindow(HTMLMainWindow):
         e.value = self.value(si, meta.EXPOSURES, 1)
         e.events.change += self.onFramesChange
 
+        self.flashState.load(self.cv(f'shooting-info/{meta.FLASHES}', []))
         for i in range(self.cv('flash-groups', 6)):
             fid = f'{meta.FLASHES}/{i}/'
             gid = chr(ord('A') + i)
@@ -680,10 +749,20 @@ class FlashControlWindow(HTMLMainWindow):
             self.setVisible('#shutter-button', True)
             self.setVisible('#flash-light-all', True)
 
-            self.godox = Godox()
+            transport = None
+            if self.cv('GodoxSimulator', False):
+                from lib.godoxsim import SimulatedTransport
+                transport = SimulatedTransport()
+            self.godox = Godox(self.cv('GodoxWriteWithoutResponse', True), 
+                               self.cv('GodoxFrameGap', 0.0), 
+                               self.cv('GodoxConnectTimeout', 3.0), 
+                               self.cv('GodoxScanTimeout', 5.0), transport,
+                               self.cv('GodoxRateLimit', 0.0), 
+                               self.cv('GodoxRateBurst', 8))
             self.godox.callback('failed', self.onGodoxFailed)
             self.godox.callback('connected', self.onGodoxConnected)
             self.godox.callback('config', self.onGodoxConfig)
+            self.godox.callback('link', self.onGodoxLink)
             self.godox.connect(self.cv('godox', {}))
 
             self.nano = NanoKontrol2()
@@ -700,9 +779,16 @@ class FlashControlWindow(HTMLMainWindow):
             if tethering_path:
                 DEBUG('Tethering folder:', tethering_path, tethering_pat)
                 self.metadata = RAWWatcher()
-                self.metadata.start(tethering_path, tethering_pat)
                 self.metadata.setJson(self.forExiftool(self.config['shooting-info']))
                 self.metadata.callback('msg', self.onMetadataMsg)
+                self.metadata.callback('queue', self.onMetadataQueue)
+                self.metadata.start(tethering_path, tethering_pat, 
+                                    self.cv('MetadataWorkers', 2), self.cv('MetadataQueueSize', 64),
+                                    self.cv('TetheringCatchUp', True), 
+                                    self.cv('TetheringSettleTime', 0.3), 
+                                    self.cv('MetadataBatchWindow', 0.05), 
+                                    self.cv('MetadataBatchSize', 16), 
+                                    self.cv('TetheringGroupWindow', 0.5))
                 self.setEnabled('#meta-button', True)
 
         else:
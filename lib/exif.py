@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#**************************************************************************
+#
+#   Copyright (c) 2025 by Petri Damstén <petri.damsten@gmail.com> 
+#                         https://petridamsten.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the
+#   Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#**************************************************************************
+
+import os
+import mmap
+import struct
+
+# Tag ids
+EXIF_IFD = 0x8769
+MAKER_NOTE = 0x927C
+DATE_TIME_ORIGINAL = 0x9003
+SUB_SEC_TIME_ORIGINAL = 0x9291
+BODY_SERIAL_NUMBER = 0xA431
+CAMERA_SERIAL_NUMBER = 0xC62F # DNG
+NIKON_SERIAL_NUMBER = 0x001D
+NIKON_SHUTTER_COUNT = 0x00A7
+FUJI_SERIAL_NUMBER = 0x0010
+FUJI_IMAGE_COUNT = 0x1438
+CANON_SERIAL_NUMBER = 0x000C
+
+SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+CANON_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+MAX_ENTRIES = 1000
+
+class IFD:
+    # Lazy view to one TIFF IFD inside the mapped file, offsets are relative to base.
+    def __init__(self, buf, base, offset, order):
+        self.buf = buf
+        self.base = base
+        self.order = order
+        self.entries = {}
+        pos = base + offset
+        count = struct.unpack_from(order + 'H', buf, pos)[0]
+        if count > MAX_ENTRIES:
+            raise ValueError('Broken IFD')
+        for i in range(count):
+            tag, typ, n = struct.unpack_from(order + 'HHI', buf, pos + 2 + i * 12)
+            self.entries[tag] = (typ, n, pos + 2 + i * 12 + 8)
+
+    def position(self, tag):
+        typ, n, pos = self.entries[tag]
+        if SIZES.get(typ, 1) * n > 4:
+            pos = self.base + struct.unpack_from(self.order + 'I', self.buf, pos)[0]
+        return typ, n, pos
+
+    def string(self, tag):
+        if tag not in self.entries:
+            return None
+        _, n, pos = self.position(tag)
+        return bytes(self.buf[pos:pos + n]).split(b'\0')[0].decode('ascii', 'replace').strip()
+
+    def int(self, tag):
+        if tag not in self.entries:
+            return None
+        typ, _, pos = self.position(tag)
+        fmt = {1: 'B', 3: 'H', 4: 'I', 9: 'i', 13: 'I'}.get(typ)
+        return struct.unpack_from(self.order + fmt, self.buf, pos)[0] if fmt else None
+
+    def sub(self, tag):
+        if tag not in self.entries:
+            return None
+        return IFD(self.buf, self.base, self.int(tag), self.order)
+
+def tiff(buf, base):
+    order = {b'II': '<', b'MM': '>'}.get(bytes(buf[base:base + 2]))
+    if not order:
+        raise ValueError('Not a TIFF header')
+    offset = struct.unpack_from(order + 'I', buf, base + 4)[0]
+    return IFD(buf, base, offset, order)
+
+def makerNote(exif):
+    if MAKER_NOTE not in exif.entries:
+        return None, None
+    _, n, pos = exif.position(MAKER_NOTE)
+    buf = exif.buf
+    head = bytes(buf[pos:pos + 12])
+    if head.startswith(b'Nikon\0'):
+        return 'Nikon', tiff(buf, pos + 10)
+    if head.startswith(b'FUJIFILM'):
+        return 'Fuji', IFD(buf, pos, struct.unpack_from('<I', buf, pos + 8)[0], '<')
+    return None, None
+
+def exifFromTiff(buf, base, info):
+    ifd0 = tiff(buf, base)
+    info['SerialNumber'] = ifd0.string(CAMERA_SERIAL_NUMBER)
+    exif = ifd0.sub(EXIF_IFD)
+    if exif:
+        fromExifIFD(exif, info)
+
+def fromExifIFD(exif, info):
+    info['DateTimeOriginal'] = exif.string(DATE_TIME_ORIGINAL)
+    info['SubSecTimeOriginal'] = exif.string(SUB_SEC_TIME_ORIGINAL)
+    info['SerialNumber'] = info.get('SerialNumber') or exif.string(BODY_SERIAL_NUMBER)
+    maker, note = makerNote(exif)
+    if maker == 'Nikon':
+        info['SerialNumber'] = info['SerialNumber'] or note.string(NIKON_SERIAL_NUMBER)
+        info['ShutterCount'] = note.int(NIKON_SHUTTER_COUNT)
+    elif maker == 'Fuji':
+        info['SerialNumber'] = info['SerialNumber'] or note.string(FUJI_SERIAL_NUMBER)
+        info['ShutterCount'] = note.int(FUJI_IMAGE_COUNT)
+
+def raf(buf, info):
+    # Exif is in the APP1 segment of the embedded JPEG preview
+    jpeg = struct.unpack_from('>I', buf, 84)[0]
+    pos = jpeg + 2
+    while pos < jpeg + 65536:
+        marker, length = struct.unpack_from('>HH', buf, pos)
+        if marker == 0xFFE1 and bytes(buf[pos + 4:pos + 10]) == b'Exif\0\0':
+            return exifFromTiff(buf, pos + 10, info)
+        if marker == 0xFFDA or marker & 0xFF00 != 0xFF00:
+            break
+        pos += 2 + length
+    raise ValueError('No Exif in RAF')
+
+def boxes(buf, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, typ = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            break
+        yield typ, pos + header, pos + size
+        pos += size
+
+def cr3(buf, info):
+    for typ, start, end in boxes(buf, 0, len(buf)):
+        if typ != b'moov':
+            continue
+        for typ, start, end in boxes(buf, start, end):
+            if typ == b'uuid' and bytes(buf[start:start + 16]) == CANON_UUID:
+                for typ, s, _ in boxes(buf, start + 16, end):
+                    if typ == b'CMT2':
+                        fromExifIFD(tiff(buf, s), info)
+                    elif typ == b'CMT3':
+                        serial = tiff(buf, s).int(CANON_SERIAL_NUMBER)
+                        if serial and not info.get('SerialNumber'):
+                            info['SerialNumber'] = str(serial)
+                return
+        return
+    raise ValueError('No moov box in CR3')
+
+def read(fname):
+    # Returns dict with DateTimeOriginal, SubSecTimeOriginal, SerialNumber and ShutterCount
+    # (None when not available) or None if file could not be parsed.
+    info = {'DateTimeOriginal': None, 'SubSecTimeOriginal': None, 
+            'SerialNumber': None, 'ShutterCount': None}
+    try:
+        with open(fname, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf:
+                if buf[:16] == b'FUJIFILMCCD-RAW ':
+                    raf(buf, info)
+                elif buf[4:8] == b'ftyp':
+                    cr3(buf, info)
+                else:
+                    exifFromTiff(buf, 0, info)
+    except (OSError, ValueError, IndexError, KeyError, TypeError, struct.error):
+        return None
+    return info
+
+def benchmark(folder, pattern = '*.RAF;*.ARW;*.NEF;*.CR3;*.DNG'):
+    import fnmatch
+    import time
+    import lib.exiftool as exiftool
+
+    pats = [p.lower() for p in pattern.split(';')]
+    files = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+             if any(fnmatch.fnmatch(f.lower(), p) for p in pats)]
+    if not files:
+        print(f'No files matching {pattern} in {folder}')
+        return
+    for f in files:
+        print(os.path.basename(f), read(f))
+    for name, func in [('exif.read', read), ('exiftool.read', exiftool.read)]:
+        t = time.perf_counter()
+        for f in files:
+            func(f)
+        t = time.perf_counter() - t
+        print(f'{name:>14}: {t / len(files) * 1000000:10.1f} us / file ({len(files)} files)')
+    exiftool.stop()
+
+def main():
+    import sys
+
+    if len(sys.argv) < 2:
+        print('Usage: python -m lib.exif <folder with RAW files> [pattern]')
+        return
+    benchmark(*sys.argv[1:3])
+
+if __name__ == '__main__':
+    main()
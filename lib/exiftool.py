@@ -23,53 +23,290 @@
 #
 #**************************************************************************
 
+import os
 import subprocess
-import lib.util as util
 import json
 import tempfile
+import time
+import atexit
+from collections import OrderedDict
+from threading import Lock, Condition
+import lib.util as util
 from lib.logger import INFO, ERROR, EXCEPTION, DEBUG
 
-def write(fname, data):
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exiftool-custom-ns.config')
+COMMON_ARGS = ["-d", "%Y:%m:%d %H:%M:%S", "-G0:1", "-n"]
+WRITE_ARGS = ["-overwrite_original_in_place"]
+READ_ARGS = ["-struct", "-json"]
+
+class ExifTool:
+    def __init__(self, executable = 'exiftool'):
+        self.executable = executable
+        self.process = None
+        self.lock = Lock()
+        self.counter = 0
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        cmd = [
+            self.executable,
+            "-config", CONFIG,
+            "-stay_open", "True",
+            "-@", "-",
+            "-common_args"
+        ] + COMMON_ARGS
+        DEBUG('Starting exiftool engine')
+        self.process = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        stderr = subprocess.PIPE, text = True, encoding = 'utf-8')
+
+    def stop(self):
+        with self.lock:
+            if not self.running():
+                self.process = None
+                return
+            DEBUG('Stopping exiftool engine')
+            try:
+                self.process.stdin.write('-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout = 2.0)
+            except Exception:
+                self.kill()
+            self.process = None
+
+    def kill(self):
+        if self.process:
+            try:
+                self.process.kill()
+                self.process.wait(timeout = 2.0)
+            except Exception:
+                pass
+            self.process = None
+
+    def readUntil(self, stream, ready):
+        lines = []
+        while True:
+            line = stream.readline()
+            if not line:
+                raise EOFError('exiftool exited')
+            if line.rstrip('\r\n') == ready:
+                return ''.join(lines)
+            lines.append(line)
+
+    def execute(self, args):
+        # Returns (ok, stdout, stderr). Engine is restarted once if it has died.
+        with self.lock:
+            for _ in range(2):
+                try:
+                    if not self.running():
+                        self.start()
+                    self.counter += 1
+                    ready = f'{{ready{self.counter}}}'
+                    lines = list(args) + ['-echo4', ready, f'-execute{self.counter}']
+                    self.process.stdin.write('\n'.join(lines) + '\n')
+                    self.process.stdin.flush()
+                    out = self.readUntil(self.process.stdout, ready)
+                    err = self.readUntil(self.process.stderr, ready)
+                    return (not failed(err), out, err)
+                except (OSError, ValueError, EOFError) as e:
+                    ERROR(f'Exiftool engine failed: {e}')
+                    self.kill()
+        return (False, '', 'Exiftool engine failed')
+
+def failed(err):
+    return any(line.startswith('Error') for line in err.splitlines())
+
+def spawn(args):
+    cmd = ["exiftool", "-config", CONFIG] + COMMON_ARGS + list(args)
+    try:
+        result = subprocess.run(cmd, capture_output = True, text = True)
+    except OSError as e:
+        return (False, '', str(e))
+    return (result.returncode == 0, result.stdout, result.stderr)
+
+_idle = []        # Engines not in use
+_engines = []     # All started engines
+_poolSize = 1
+_poolLock = Condition()
+
+def setEngines(n):
+    # One engine per metadata worker so writes do not queue behind each other
+    global _poolSize
+
+    with _poolLock:
+        _poolSize = max(1, n)
+        _poolLock.notify_all()
+
+def acquireEngine():
+    with _poolLock:
+        while not _idle and len(_engines) >= _poolSize:
+            _poolLock.wait()
+        if _idle:
+            return _idle.pop()
+        e = ExifTool()
+        _engines.append(e)
+        return e
+
+def releaseEngine(e):
+    with _poolLock:
+        if e in _engines:
+            _idle.append(e)
+        _poolLock.notify()
+
+def stop():
+    with _poolLock:
+        engines = list(_engines)
+        _engines.clear()
+        _idle.clear()
+    for e in engines:
+        e.stop()
+    clearPayloads()
+
+atexit.register(stop)
+
+def run(args, spawned = False):
+    if spawned:
+        return spawn(args)
+    e = acquireEngine()
+    try:
+        return e.execute(args)
+    finally:
+        releaseEngine(e)
+
+def write(fname, data, spawned = False):
+    return writeMany([fname], data, spawned)[fname]
+
+_payloads = OrderedDict() # key -> [path, users, evicted], least recently used first
+_payloadsLock = Lock()
+PAYLOAD_CACHE_SIZE = 8
+
+def payloadFile(data):
+    tmp = tempfile.NamedTemporaryFile(mode = 'w', suffix = '.json', delete = False)
+    DEBUG(f"Temp file path: {tmp.name}")
+    tmp.write(json.dumps({"SourceFile": "*", **data}))
+    tmp.close()
+    return tmp.name
+
+def removeFile(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def evict(entry):
+    # File is removed when the last writer using it releases it
+    entry[2] = True
+    if entry[1] == 0:
+        removeFile(entry[0])
+
+def acquirePayload(key, data):
+    # Same payload (by content hash key) reuses the same temp json file, release when done
+    with _payloadsLock:
+        entry = _payloads.get(key)
+        if entry:
+            _payloads.move_to_end(key)
+        else:
+            while len(_payloads) >= PAYLOAD_CACHE_SIZE:
+                evict(_payloads.popitem(last = False)[1])
+            entry = _payloads[key] = [payloadFile(data), 0, False]
+        entry[1] += 1
+        return entry
+
+def releasePayload(entry):
+    with _payloadsLock:
+        entry[1] -= 1
+        if entry[2] and entry[1] == 0:
+            removeFile(entry[0])
+
+def clearPayloads():
+    with _payloadsLock:
+        for entry in _payloads.values():
+            evict(entry)
+        _payloads.clear()
+
+def writeMany(fnames, data, spawned = False, key = None):
+    # Writes the same data to all files with one exiftool run, returns {fname: error or None}
+    tmp = None
+    entry = None
     if isinstance(data, dict):
-        tmp = tempfile.NamedTemporaryFile(mode = 'w', delete = False)
-        DEBUG(f"Temp file path: {tmp.name}")
-        tmp.write(json.dumps(data))
-        tmp.close()
-        data = tmp.name
-
-    cmd = [
-        "exiftool",
-        "-config", util.path('lib/exiftool-custom-ns.config'),
-        "-d", "%Y:%m:%d %H:%M:%S",
-        "-G0:1",
-        "-n",
-        "-overwrite_original_in_place",
-        f"-json={data}",
-        fname
-    ]
-    result = subprocess.run(cmd, capture_output = True, text = True)
-    if result.returncode != 0:
-        return f"Exiftool failed: {result.stderr.strip()}"
-    return None
-
-def read(fname):
-    cmd = [
-        "exiftool",
-        "-config", util.path('lib/exiftool-custom-ns.config'),
-        "-d", "%Y:%m:%d %H:%M:%S",
-        "-G0:1",
-        "-n",
-        "-struct",
-        "-json",
-        fname
-    ]
-    result = subprocess.run(cmd, capture_output = True, text = True)
-    if result.returncode != 0:
+        if key:
+            entry = acquirePayload(key, data)
+            data = entry[0]
+        else:
+            tmp = payloadFile(data)
+            data = tmp
+
+    try:
+        ok, _, err = run(WRITE_ARGS + [f"-json={data}"] + list(fnames), spawned)
+    finally:
+        if tmp:
+            os.remove(tmp)
+        if entry:
+            releasePayload(entry)
+    errors = {}
+    for line in err.splitlines():
+        for fname in fnames:
+            if line.startswith('Error') and line.endswith(f' - {fname}'):
+                errors[fname] = f"Exiftool failed: {line.strip()}"
+    if not ok and not errors:
+        errors = {fname: f"Exiftool failed: {err.strip()}" for fname in fnames}
+    return {fname: errors.get(fname) for fname in fnames}
+
+def read(fname, spawned = False):
+    ok, out, _ = run(READ_ARGS + [fname], spawned)
+    if not ok:
         return None
     try:
-        data = json.loads(result.stdout.strip())[0]
+        data = json.loads(out.strip())[0]
         return data
     except Exception as e:
         EXCEPTION("Error parsing JSON.")
         return None
 
+def readTags(fname, tags, spawned = False):
+    # Header only read (-fast2), keys without group prefixes
+    ok, out, _ = run(["-fast2", "-json"] + [f"-{t}" for t in tags] + [fname], spawned)
+    if not ok:
+        return None
+    try:
+        data = json.loads(out.strip())[0]
+    except Exception as e:
+        EXCEPTION("Error parsing JSON.")
+        return None
+    return {k.split(':')[-1]: v for k, v in data.items()}
+
+def benchmark(folder, pattern = '*.RAF;*.ARW;*.NEF;*.CR3;*.DNG'):
+    import fnmatch
+
+    pats = [p.lower() for p in pattern.split(';')]
+    files = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+             if any(fnmatch.fnmatch(f.lower(), p) for p in pats)]
+    if not files:
+        print(f'No files matching {pattern} in {folder}')
+        return
+    data = {"XMP:XMP-pdplus:Stand": "Benchmark"}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for spawned in [True, False]:
+            name = 'spawn-per-file' if spawned else 'stay_open'
+            for op in ['read', 'write']:
+                t = time.perf_counter()
+                for i, fname in enumerate(files):
+                    if op == 'read':
+                        read(fname, spawned)
+                    else:
+                        write(os.path.join(tmpdir, f'{name}-{i}.xmp'), data, spawned)
+                t = time.perf_counter() - t
+                print(f'{name:>14} {op:>5}: {len(files) / t:8.1f} files/sec ({len(files)} files)')
+    stop()
+
+def main():
+    import sys
+
+    if len(sys.argv) < 2:
+        print('Usage: python -m lib.exiftool <folder with RAW files> [pattern]')
+        return
+    benchmark(*sys.argv[1:3])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#**************************************************************************
+#
+#   Copyright (c) 2025 by Petri Damstén <petri.damsten@gmail.com>
+#                         https://petridamsten.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the
+#   Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#**************************************************************************
+
+from collections import OrderedDict
+from threading import Lock
+
+import lib.metadata as meta
+
+class FlashState:
+    # Flash group fields with a version counter per field. Consumers keep the version they have
+    # seen and ask for the changes since it, getting only the changed groups and fields.
+    def __init__(self):
+        self.lock = Lock()
+        self.version = 0
+        self.values = {}
+        self.versions = OrderedDict() # (gid, field) -> version, most recently changed last
+
+    def set(self, gid, field, value):
+        key = (gid, field)
+        with self.lock:
+            if key in self.values and self.values[key] == value:
+                return False
+            self.version += 1
+            self.values[key] = value
+            self.versions[key] = self.version
+            self.versions.move_to_end(key)
+            return True
+
+    def get(self, gid, field, default = None):
+        return self.values.get((gid, field), default)
+
+    def load(self, flashes):
+        # Older files have ID or no id at all, the group is then the position in the list
+        for i, flash in enumerate(flashes):
+            gid = flash.get(meta.ID, flash.get('ID', chr(ord('A') + i)))
+            for field, value in flash.items():
+                if field not in (meta.ID, 'ID'):
+                    self.set(gid, field, value)
+
+    def changes(self, since = 0):
+        # (version, [{Id: gid, field: value, ...}]), walks only the fields changed after since
+        with self.lock:
+            groups = {}
+            for key in reversed(self.versions):
+                if self.versions[key] <= since:
+                    break
+                gid, field = key
+                groups.setdefault(gid, {meta.ID: gid})[field] = self.values[key]
+            return self.version, [groups[gid] for gid in sorted(groups)]
@@ -24,246 +24,668 @@
 #**************************************************************************
 
 from threading import Thread
-from queue import Queue
 import asyncio
 import time
-from copy import deepcopy
+import random
+import heapq
 
-from bleak import BleakScanner
-from bleak import BleakClient
-import PyObjCTools
-from crccheck.crc import Crc8Maxim
+from functools import lru_cache
+try:
+    from bleak import BleakScanner
+    from bleak import BleakClient
+except ImportError:
+    # Only the simulated transport (lib/godoxsim.py) is available
+    BleakScanner = BleakClient = None
 
 import lib.metadata as meta
 import lib.power as power
+import lib.latency as latency
 from lib.logger import INFO, ERROR, EXCEPTION, DEBUG, VERBOSE
 
-class Godox:
+NAME_PREFIX = 'GDBH'
+POWER_UUID = '0000fec7'
+TRIGGER_UUID = '0000fff1'
+
+def crc8Table():
+    # CRC-8/MAXIM (Dallas 1-Wire), reflected polynomial 0x31
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8C if crc & 1 else crc >> 1
+        table.append(crc)
+    return bytes(table)
+
+CRC8_TABLE = crc8Table()
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+def checksum(command):
+    return bytes(command) + bytes([crc8(command)])
+
+GROUPS = {g: int(g, 16) for g in '0123456789ABCDEF'}
+MODES = {'-': 3, 'T': 0, 'M': 1}
+MANUAL_LEVELS = range(101)
+TTL_LEVELS = [n for n in range(31)] + [0x80 + n for n in range(1, 31)]
+
+def powerCommand(group, mode, level):
+    cmd = list(bytes.fromhex("F0A10700000000000100"))
+    cmd[3] = group
+    cmd[4] = mode
+    if mode == MODES['M']:
+        cmd[5] = level
+    elif mode == MODES['T']:
+        cmd[5] = 0x17
+        cmd[9] = level
+    return checksum(cmd)
+
+def frameTable():
+    # Every power frame there is: 16 groups x (manual levels + TTL levels + off)
+    frames = {}
+    for group in GROUPS.values():
+        for level in MANUAL_LEVELS:
+            frames[(group, MODES['M'], level)] = powerCommand(group, MODES['M'], level)
+        for level in TTL_LEVELS:
+            frames[(group, MODES['T'], level)] = powerCommand(group, MODES['T'], level)
+        frames[(group, MODES['-'], 0)] = powerCommand(group, MODES['-'], 0)
+    return frames
+
+FRAMES = frameTable()
+
+def beepAndLightCommand(beep, light):
+    cmd = list(bytes.fromhex("F0A00A00000003000000FF0000"))
+    cmd[3] = 0 # 0 = Channel 01
+    cmd[4] = int(beep)
+    cmd[5] = int(light)
+    cmd[7] = 0 # strobe mode
+    cmd[8] = 1 # Hz
+    cmd[9] = 1 # Times
+    return checksum(cmd)
+
+BEEP_AND_LIGHT = {(beep, light): beepAndLightCommand(beep, light) 
+                  for beep in [False, True] for light in [False, True]}
+
+@lru_cache(maxsize = 1024)
+def level(mode, pwr):
+    if mode == 'M':
+        return power.power2godox(pwr)
+    elif mode == 'T':
+        return power.ttl2godox(pwr)
+    return 0
+
+def powerFrame(group, mode, pwr = '1/1'):
+    key = (GROUPS[group], MODES[mode], level(mode, pwr))
+    frame = FRAMES.get(key)
+    return frame if frame else powerCommand(*key)
+
+# Scheduler priority classes, smaller goes first
+FIRE = 0
+MODE = 1
+POWER = 2
+COSMETIC = 3
+PRIORITIES = ('fire', 'mode', 'power', 'cosmetic')
+
+class NotConnected(ConnectionError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def delay(self):
+        # Takes a token and returns 0 or returns seconds until there is one
+        if self.rate <= 0:
+            return 0.0
+        t = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (t - self.last) * self.rate)
+        self.last = t
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class Command:
+    def __init__(self, priority, seq, frame, char, key):
+        self.priority = priority
+        self.seq = seq
+        self.frame = frame
+        self.char = char
+        self.key = key
+        self.futures = []
+        self.queued = time.monotonic()
+        self.replaced = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CommandScheduler:
+    # Sends frames highest priority first, optionally rate limited (rate frames/s, 0 = no limit).
+    # A frame with the same key as a queued one replaces it (latest power for a group wins) and 
+    # keeps its place in line.
+    def __init__(self, send, rate = 0.0, burst = 8, frameGap = 0.0):
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.frameGap = frameGap
+        self.heap = []
+        self.keyed = {}
+        self.seq = 0
+        self.task = None
+        self.lastSent = 0.0
+        self.dropped = 0
+        self.waits = [latency.Histogram() for _ in PRIORITIES]
+
+    def put(self, priority, frame, char = None, key = None):
+        future = asyncio.get_running_loop().create_future()
+        cmd = self.keyed.get(key) if key is not None else None
+        if cmd:
+            self.dropped += 1
+            cmd.frame = frame
+            cmd.char = char
+            if priority < cmd.priority:
+                # Mode change after a queued power change, move it forward
+                cmd.replaced = True
+                old = cmd
+                cmd = self.push(priority, frame, char, key)
+                cmd.futures = old.futures
+                cmd.queued = old.queued
+        else:
+            cmd = self.push(priority, frame, char, key)
+        cmd.futures.append(future)
+        if not self.task:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return future
+
+    def push(self, priority, frame, char, key):
+        self.seq += 1
+        cmd = Command(priority, self.seq, frame, char, key)
+        heapq.heappush(self.heap, cmd)
+        if key is not None:
+            self.keyed[key] = cmd
+        return cmd
+
+    def depth(self):
+        return len(self.keyed) + sum(1 for cmd in self.heap if cmd.key is None)
+
+    async def run(self):
+        try:
+            while self.heap:
+                delay = self.bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                if self.frameGap > 0:
+                    # Pause the trigger needs between frames
+                    delay = self.lastSent + self.frameGap - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                cmd = None
+                while self.heap and not cmd:
+                    cmd = heapq.heappop(self.heap)
+                    if cmd.replaced:
+                        cmd = None
+                if not cmd:
+                    break
+                if cmd.key is not None:
+                    self.keyed.pop(cmd.key, None)
+                self.waits[cmd.priority].record(time.monotonic() - cmd.queued)
+                try:
+                    await self.send(cmd.frame, cmd.char)
+                except Exception as e:
+                    for future in cmd.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                finally:
+                    self.lastSent = time.monotonic()
+                for future in cmd.futures:
+                    if not future.done():
+                        future.set_result(True)
+        finally:
+            self.task = None
+
+    async def drain(self):
+        while self.task:
+            try:
+                await asyncio.shield(self.task)
+            except Exception:
+                pass
+
+    def lines(self):
+        lines = [f'queue: depth {self.depth()}, {self.dropped} stale frames dropped']
+        for name, h in zip(PRIORITIES, self.waits):
+            if h.count:
+                lines.append(f'{name} wait: n={h.count} p50 {h.percentile(50) * 1000:.1f} ms, '
+                             f'p99 {h.percentile(99) * 1000:.1f} ms')
+        return lines
+
+
+class BleakTransport:
+    # BLE access used by GodoxWorker, lib/godoxsim.py has a simulated one with the same methods
     def __init__(self):
+        if BleakClient is None:
+            raise RuntimeError('bleak is not installed')
+
+    async def scan(self, matches, timeout):
+        return await BleakScanner.find_device_by_filter(matches, timeout = timeout)
+
+    def client(self, target, disconnected, services = None, timeout = 3.0):
+        return BleakClient(target, disconnected, services = services, timeout = timeout)
+
+
+class Godox:
+    # Owns one asyncio loop thread running GodoxWorker. Public methods can be called from any 
+    # thread and return concurrent.futures.Future that resolves when the BLE write is done.
+    def __init__(self, writeWithoutResponse = True, frameGap = 0.0, 
+                 connectTimeout = 3.0, scanTimeout = 5.0, transport = None,
+                 rate = 0.0, burst = 8):
         self.callbacks = {}
-        self.fromWorkerQueue = Queue()
-        self.toWorkerQueue = Queue()
-        self.worker = GodoxWorker(self.toWorkerQueue, self.fromWorkerQueue)
-        self.worker.start()
-        self.poller = Thread(target = self.poll)
-        self.poller.start()
+        self.loop = asyncio.new_event_loop()
+        self.worker = GodoxWorker(self.emit, writeWithoutResponse, frameGap, 
+                                  connectTimeout, scanTimeout, transport, rate, burst)
+        self.thread = Thread(target = self.run)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
 
     def callback(self, name, callback):
         self.callbacks[name] = callback
 
+    def emit(self, cmd, data = None):
+        # Called in the loop thread
+        if cmd in self.callbacks:
+            try:
+                self.callbacks[cmd](data)
+            except Exception:
+                EXCEPTION(f'Callback {cmd} failed')
+
+    def submit(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self.logError)
+        return future
+
+    @staticmethod
+    def logError(future):
+        if future.cancelled() or not future.exception():
+            return
+        if isinstance(future.exception(), NotConnected):
+            # Normal when working without a trigger
+            DEBUG(f'Godox command dropped: {future.exception()}')
+        else:
+            ERROR(f'Godox command failed: {future.exception()}')
+
     def connect(self, cfg):
-        self.sendMsg('connect', cfg)
+        return self.submit(self.worker.connect(cfg))
 
-    def setValues(self, values):
-        self.sendMsg('setValues', values)
+    def setValues(self, values, origin = None):
+        # Values are the changed fields per group ({Id: gid, field: value}). Copy, caller keeps
+        # modifying its dicts. Origin is latency.now() of the UI event.
+        latency.record('enqueue', origin)
+        return self.submit(self.worker.setValues([dict(v) for v in values], origin))
 
     def setBeepAndLight(self, beep = True, light = True):
-        self.sendMsg('setBeepAndLight', (beep, light))
+        return self.submit(self.worker.setBeepAndLight(beep, light))
 
     def test(self):
-        self.sendMsg('test')
+        return self.submit(self.worker.test())
 
-    def stop(self):
-        self.fromWorkerQueue.put(('quit', None))
-        self.poller.join()
+    def metrics(self):
+        # Future with queue depth and wait time lines
+        return self.submit(self.worker.metrics())
 
+    def stop(self):
         INFO('Godox::close')
-        self.sendMsg('stop')
-        if self.worker:
-            self.worker.join()
-            self.worker = None
-
-    def sendMsg(self, cmd, data = None):
-        if self.worker:
-            self.toWorkerQueue.put((cmd, data))
-
-    def poll(self):
-        while True:
-            cmd, data = self.fromWorkerQueue.get()
-
-            if cmd in self.callbacks:
-                self.callbacks[cmd](data)
-            if cmd == 'quit':
-                DEBUG('Godox::poll quit')
-                return
-
-
-class GodoxWorker(Thread):
-    modes = {'-': 3, 'T': 0, 'M': 1}
-
-    def __init__(self, inQueue, outQueue):
-        super().__init__()
+        if self.thread:
+            try:
+                self.submit(self.worker.stop()).result(timeout = 5.0)
+            except Exception as e:
+                ERROR(f'Godox stop failed: {e}')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+
+class GodoxWorker:
+    def __init__(self, emit = None, writeWithoutResponse = True, frameGap = 0.0, 
+                 connectTimeout = 3.0, scanTimeout = 5.0, transport = None, 
+                 rate = 0.0, burst = 8):
         self.config = {}
-        self.inQueue = inQueue
-        self.outQueue = outQueue
+        self.emit = emit
+        self.transport = transport if transport else BleakTransport()
+        self.writeWithoutResponse = writeWithoutResponse
+        self.connectTimeout = connectTimeout
+        self.scanTimeout = scanTimeout
+        self.noResponse = False
         self.client = None
+        self.powerChar = None
+        self.triggerChar = None
         self.pastValues = {}
         self.startTime = 0
+        self.scheduler = CommandScheduler(self.sendCommand, rate, burst, frameGap)
+        self.beepAndLight = None
+        self.supervisor = None
+        self.linkLost = False
+        self.stopping = False
+        self.backoffMin = 0.5
+        self.backoffMax = 30.0
 
     def sendMsg(self, cmd, data = None):
-        if self.outQueue:
-            self.outQueue.put((cmd, data))
+        if self.emit:
+            self.emit(cmd, data)
+
+    def known(self, device, adv):
+        name = device.name or adv.local_name or ''
+        return name == self.config.get('name') or device.address == self.config.get('address')
+
+    def anyTrigger(self, device, adv):
+        name = device.name or adv.local_name or ''
+        return name.startswith(NAME_PREFIX)
 
     async def scan(self):
+        # Targeted scan: stops at the first matching trigger instead of full discovery.
+        # The known trigger is preferred, any trigger is accepted if it does not show up.
+        filters = [self.known, self.anyTrigger] if self.config.get('name') else [self.anyTrigger]
         INFO('scanning...')
-        name = None
+        device = None
         try:
-            devices = await BleakScanner.discover()
+            for matches in filters:
+                if matches is not filters[0]:
+                    INFO(f'{self.config["name"]} not found, scanning for any Godox...')
+                device = await self.transport.scan(matches, self.scanTimeout)
+                if device:
+                    break
         except Exception as e:
             EXCEPTION('Scanning Failed.')
-            self.sendMsg('failed', str(e))
-            return False
-        godox = None
-        for device in devices:
-            name = str(PyObjCTools.KeyValueCoding.getKey(device.details, 'name')[0])
-            #VERBOSE(name)
-            if name.startswith('GDBH'):
-                INFO(f'Godox found: {name}')
-                godox = device
-                break
-        uuid = None
-        iuuid = ''
-        address = ''
-        if godox:
-            address = str(PyObjCTools.KeyValueCoding.getKey(godox.details, 'identifier')[0])
-            DEBUG(f'Godox address: {address}')
-            async with BleakClient(address) as client:
+            return None
+        if device:
+            INFO(f'Godox found: {device.name} ({device.address})')
+        return device
+
+    def findCharacteristics(self, client):
+        # Uses handles from config when possible, otherwise looks for the uuids
+        chars = {}
+        for key, prefix in [('', POWER_UUID), ('trigger_', TRIGGER_UUID)]:
+            ch = None
+            if self.config.get(key + 'handle') is not None:
+                ch = client.services.get_characteristic(self.config[key + 'handle'])
+                if ch and not ch.uuid.startswith(prefix):
+                    ch = None
+            if not ch:
                 for service in client.services:
                     VERBOSE(service.description)
-                    for ch in service.characteristics:
-                        VERBOSE(ch.uuid)
-                        if ch.uuid.startswith('0000fec7'):
-                            uuid = ch.uuid
-                        if ch.uuid.startswith('0000fff1'):
-                            iuuid = ch.uuid
-        if uuid:
-            self.config = {}
-            self.config['name'] = name
-            self.config['address'] = address
-            self.config['uuid'] = uuid
-            self.config['trigger_uuid'] = iuuid
-            VERBOSE(self.config)
-            self.sendMsg('config', self.config)
-            return True
-        else:
-            ERROR('GodoxWorker::scan failed', self.config)
-            self.sendMsg('failed', self.config['name'] if name and name in self.config else None)
+                    for c in service.characteristics:
+                        VERBOSE(c.uuid)
+                        if c.uuid.startswith(prefix):
+                            ch = c
+            chars[key] = ch
+        return chars[''], chars['trigger_']
+
+    async def open(self, target, name, report = True):
+        client = self.transport.client(target, self.onDisconnected, 
+                                       self.config.get('services'), self.connectTimeout)
+        self.startTime = time.time()
+        try:
+            await client.connect()
+            power, trigger = self.findCharacteristics(client)
+            if not power or not trigger:
+                raise RuntimeError('Godox characteristics not found')
+            self.client = client
+            self.powerChar = power
+            self.triggerChar = trigger
+            await self.init()
+        except Exception as e:
+            ERROR(f'connect failed {e}')
+            # Cleared first so that onDisconnected ignores this client
+            self.client = None
+            self.powerChar = None
+            self.triggerChar = None
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
             return False
-
-    async def connect(self):
-        tries = 0
-        while tries < 2:
-            if self.client and self.client.is_connected:
-                INFO('already connected')
-                return True
-
-            if 'address' in self.config:
-                if not self.client:
-                    self.client = BleakClient(self.config['address'])
+        config = {
+            'name': name,
+            'address': client.address,
+            'uuid': power.uuid,
+            'trigger_uuid': trigger.uuid,
+            'handle': power.handle,
+            'trigger_handle': trigger.handle,
+            'services': sorted(set([power.service_uuid, trigger.service_uuid])),
+        }
+        if config != {k: self.config.get(k) for k in config}:
+            self.config.update(config)
+            VERBOSE(self.config)
+            self.sendMsg('config', dict(self.config))
+        INFO(f'Connected in {time.time() - self.startTime:.2f}s')
+        if report:
+            self.sendMsg('connected', name)
+        return True
+
+    def onDisconnected(self, client):
+        if client is not self.client or self.stopping:
+            return
+        INFO('Godox disconnected')
+        self.sendMsg('link', 'disconnected')
+        # A running supervisor sees this and tries again
+        self.linkLost = True
+        if not self.supervisor:
+            self.supervisor = asyncio.get_running_loop().create_task(self.supervise())
+
+    async def supervise(self):
+        # Reconnects with jittered exponential backoff and restores the trigger state
+        attempt = 0
+        try:
+            while not self.stopping:
+                delay = random.uniform(0.0, min(self.backoffMax, self.backoffMin * (2 ** attempt)))
+                DEBUG(f'Reconnecting in {delay:.2f}s')
+                await asyncio.sleep(delay)
+                attempt += 1
+                self.sendMsg('link', 'reconnecting')
+                self.linkLost = False
                 try:
-                    self.startTime = time.time()
-                    await self.client.connect()
-                    await self.init()
-                    self.sendMsg('connected', self.config['name'])
-                    return True
+                    if not await self.connect(report = False):
+                        continue
+                    await self.replay()
                 except Exception as e:
-                    ERROR(f'connect failed {e}')
+                    ERROR(f'Reconnecting failed: {e}')
+                    continue
+                if not self.linkLost and self.client and self.client.is_connected:
+                    self.sendMsg('link', 'connected')
+                    return
+                DEBUG('Link lost again while reconnecting')
+        finally:
+            self.supervisor = None
+
+    async def replay(self):
+        # Trigger may have lost its state, send all groups and beep/light in one burst
+        futures = [self.scheduler.put(POWER, powerFrame(v[meta.ID], v[meta.MODE][0], v[meta.POWER]),
+                                      key = v[meta.ID]) for v in self.pastValues.values() 
+                   if meta.MODE in v and meta.POWER in v]
+        if self.beepAndLight:
+            futures.append(self.scheduler.put(COSMETIC, BEEP_AND_LIGHT[self.beepAndLight], 
+                                              key = 'beep'))
+        await asyncio.gather(*futures)
+
+    async def connect(self, cfg = None, report = True):
+        # Cached address first, then a short name filtered scan
+        if cfg is not None:
+            self.config = dict(cfg)
+        if self.client and self.client.is_connected:
+            INFO('already connected')
+            return True
+        self.client = None
 
-            if not await self.scan():
-                return False
+        if self.config.get('address'):
+            if await self.open(self.config['address'], self.config.get('name'), report):
+                return True
+            # Services might have changed, resolve all of them next time
+            self.config.pop('services', None)
 
-            tries += 1
+        device = await self.scan()
+        if device and await self.open(device, device.name, report):
+            return True
 
-    @staticmethod
-    def checksum(command):
-        crcinst = Crc8Maxim()
-        crcinst.process(command)
-        return command + crcinst.finalbytes()
+        ERROR('GodoxWorker::connect failed', self.config)
+        if report:
+            self.sendMsg('failed', self.config.get('name'))
+        return False
 
     async def test(self):
+        if self.offline():
+            raise NotConnected('Godox not connected')
         t = int((time.time() - self.startTime) * 1000)
         cmd = bytearray(f"{t},Test", encoding="utf-8")
-        await self.sendCommand(cmd, self.config['trigger_uuid'])
+        await self.scheduler.put(FIRE, cmd, self.triggerChar)
 
     async def init(self):
+        self.noResponse = False
+        if self.writeWithoutResponse:
+            self.noResponse = 'write-without-response' in self.powerChar.properties
+        DEBUG(f'Write without response: {self.noResponse}')
         cmd = bytes.fromhex("3535313737322C507375622C30303030")
-        await self.sendCommand(cmd, self.config['trigger_uuid'])
-
-    async def setValues(self, values):
-        def eq(key, i, a, b):
-            if i >= len(a) or i >= len(b):
-                return False
-            if key not in a[i] or key not in b[i]:
-                return False
-            if a[i][key] != b[i][key]:
-                return False
-            return True
+        await self.sendCommand(cmd, self.triggerChar)
+
+    async def setValues(self, values, origin = None):
+        latency.record('dequeue', origin)
+        await self.sendValues(values, () if origin is None else (origin,))
+
+    async def sendValues(self, values, origins = ()):
+        # Values carry only changed fields, they are merged into the group state. A newer frame
+        # for a group still in the queue replaces it.
+        futures = []
+        held = False
+        offline = self.offline()
+        for v in values:
+            gid = v[meta.ID]
+            group = self.pastValues.setdefault(gid, {meta.ID: gid})
+            group.update(v)
+            if meta.MODE in v:
+                priority = MODE
+            elif meta.POWER in v:
+                priority = POWER
+            else:
+                continue
+            if meta.MODE not in group or meta.POWER not in group:
+                continue
+            if self.supervisor:
+                # Link is down, values are replayed once reconnected
+                held = True
+                continue
+            if offline:
+                continue
+            frame = powerFrame(gid, group[meta.MODE][0], group[meta.POWER])
+            futures.append(self.scheduler.put(priority, frame, key = gid))
+        t = latency.now()
+        for origin in origins:
+            latency.record('frame', origin, t)
+        if offline:
+            raise NotConnected('Godox not connected')
+        if held:
+            await self.waitLink()
+        if futures:
+            await asyncio.gather(*futures)
+        t = latency.now()
+        for origin in origins:
+            latency.record('write', origin, t)
+
+    async def waitLink(self):
+        # Held until the supervisor has reconnected and replayed the state, fails if it gives up
+        task = self.supervisor
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        if not self.client or not self.client.is_connected:
+            raise ConnectionError('Godox not connected')
 
-        for i, v in enumerate(values):
-            if not eq(meta.POWER, i, self.pastValues, values) or \
-               not eq(meta.MODE, i, self.pastValues, values):
-                await self.setPower(v[meta.ID], v[meta.MODE][0], v[meta.POWER])
-        self.pastValues = deepcopy(values)
+    def offline(self):
+        # No trigger and no reconnect going on, nothing is queued until one is connected
+        return not self.client and not self.supervisor
 
     async def setBeepAndLight(self, beep = True, light = True):
-        cmd = list(bytes.fromhex("F0A00A00000003000000FF0000"))
-        cmd[3] = 0 # 0 = Channel 01
-        cmd[4] = int(beep)
-        cmd[5] = int(light)
-        cmd[7] = 0 # strobe mode
-        cmd[8] = 1 # Hz
-        cmd[9] = 1 # Times
-        await self.sendCommand(self.checksum(bytearray(cmd)))
-
-    async def setPower(self, group, mode, pwr = '1/1'):
-        cmd = list(bytes.fromhex("F0A10700000000000100"))
-        cmd[3] = int('0' + group, 16)
-        cmd[4] = int(GodoxWorker.modes[mode])
-        if mode == 'M':
-            cmd[5] = power.power2godox(pwr)
-        elif mode == 'T':
-            cmd[5] = 0x17
-            cmd[9] = power.ttl2godox(pwr)
-        await self.sendCommand(self.checksum(bytearray(cmd)))
-
-    async def sendCommand(self, command, uuid = None):
-        if self.client and self.client.is_connected:
-            uuid = uuid if uuid else self.config['uuid']
-            VERBOSE(f'{command}: {uuid}')
-            VERBOSE(' '.join('{:02x}'.format(x) for x in command))
-            await self.client.write_gatt_char(uuid, command)
+        self.beepAndLight = (bool(beep), bool(light))
+        if self.supervisor:
+            await self.waitLink()
+            return
+        if self.offline():
+            raise NotConnected('Godox not connected')
+        await self.scheduler.put(COSMETIC, BEEP_AND_LIGHT[self.beepAndLight], key = 'beep')
+
+    async def metrics(self):
+        return self.scheduler.lines()
+
+    async def sendCommand(self, command, char = None):
+        if not self.client or not self.client.is_connected:
+            raise NotConnected('Godox not connected')
+        response = (char is not None) or not self.noResponse
+        char = char if char else self.powerChar
+        VERBOSE(f'{command}: {char.uuid}')
+        VERBOSE(' '.join('{:02x}'.format(x) for x in command))
+        await self.client.write_gatt_char(char, command, response = response)
 
     async def stop(self):
+        self.stopping = True
+        if self.supervisor:
+            # Callers held by waitLink fail with ConnectionError
+            task = self.supervisor
+            task.cancel()
+            await asyncio.gather(task, return_exceptions = True)
+            await asyncio.sleep(0)
+        await self.scheduler.drain()
+        for line in self.scheduler.lines():
+            DEBUG(line)
         if self.client:
             if self.client.is_connected:
                 INFO('disconnect bt')
                 await self.client.disconnect()
 
-    async def loop(self):
-        while True:
-            cmd, data = self.inQueue.get()
-            VERBOSE(f'Command: {cmd}', data)
-
-            if cmd == 'connect':
-                self.config = data
-                await self.connect()
-            elif cmd == 'stop':
-                await self.stop()
-                return
-            elif cmd == 'setValues':
-                await self.setValues(data)
-            elif cmd == 'setBeepAndLight':
-                await self.setBeepAndLight(data[0], data[1])
-            elif cmd == 'test':
-                await self.test()
-            else:
-                ERROR('unknown command', cmd)
-
-    def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.loop())
-        loop.close()
+async def benchmark(cfg, rounds = 20, groups = 6):
+    # Compares acknowledged writes against write without response on a real trigger
+    worker = GodoxWorker()
+    if not await worker.connect(cfg):
+        print('Unable to connect')
+        return
+    values = [{meta.ID: chr(ord('A') + i), meta.MODE: 'M', meta.POWER: '10'} for i in range(groups)]
+    supported = worker.noResponse
+    for noResponse in [False, True]:
+        if noResponse and not supported:
+            print('Write without response not supported')
+            break
+        worker.noResponse = noResponse
+        latencies = []
+        start = time.perf_counter()
+        for r in range(rounds):
+            for v in values:
+                v[meta.POWER] = str(2.0 + r % 9)
+            t = time.perf_counter()
+            await worker.sendValues(values)
+            latencies.append(time.perf_counter() - t)
+        total = time.perf_counter() - start
+        latencies.sort()
+        name = 'without response' if noResponse else 'with response'
+        print(f'{name:>17}: {groups} groups p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+              f'max {latencies[-1] * 1000:.1f} ms, {rounds * groups / total:.1f} frames/s')
+    await worker.stop()
+
+def main():
+    import lib.util as util
+
+    cfg = util.json('user/config.json').get('godox', {})
+    asyncio.run(benchmark(cfg))
 
 if __name__ == '__main__':
-    pass
+    main()
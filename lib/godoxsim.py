@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#**************************************************************************
+#
+#   Copyright (c) 2025 by Petri Damstén <petri.damsten@gmail.com>
+#                         https://petridamsten.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the
+#   Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#**************************************************************************
+
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+import lib.godox as godox
+import lib.metadata as meta
+import lib.latency as latency
+from lib.logger import INFO, ERROR, EXCEPTION, DEBUG, VERBOSE
+
+SERVICE_UUID = '0000fee0-0000-1000-8000-00805f9b34fb'
+TRIGGER_SERVICE_UUID = '0000fff0-0000-1000-8000-00805f9b34fb'
+POWER_CHAR_UUID = godox.POWER_UUID + '-0000-1000-8000-00805f9b34fb'
+TRIGGER_CHAR_UUID = godox.TRIGGER_UUID + '-0000-1000-8000-00805f9b34fb'
+INIT_COMMAND = bytes.fromhex('3535313737322C507375622C30303030')
+
+class SimulatedServices:
+    # Mimics the parts of BleakGATTServiceCollection GodoxWorker uses
+    def __init__(self):
+        self.power = SimpleNamespace(uuid = POWER_CHAR_UUID, handle = 12, 
+                                     service_uuid = SERVICE_UUID,
+                                     properties = ['write', 'write-without-response'])
+        self.trigger = SimpleNamespace(uuid = TRIGGER_CHAR_UUID, handle = 15, 
+                                       service_uuid = TRIGGER_SERVICE_UUID,
+                                       properties = ['write', 'notify'])
+        self.services = [
+            SimpleNamespace(uuid = SERVICE_UUID, description = 'Godox power', 
+                            characteristics = [self.power]),
+            SimpleNamespace(uuid = TRIGGER_SERVICE_UUID, description = 'Godox trigger', 
+                            characteristics = [self.trigger]),
+        ]
+
+    def __iter__(self):
+        return iter(self.services)
+
+    def get_characteristic(self, handle):
+        for c in [self.power, self.trigger]:
+            if c.handle == handle:
+                return c
+        return None
+
+
+class SimulatedTrigger:
+    # In-process Godox trigger: decodes frames, verifies CRC8 and keeps the resulting flash state.
+    # Latencies are per write, dropAfter disconnects after that many writes.
+    def __init__(self, name = 'GDBH-SIM', address = 'SIM:00:00:00:00:01', latency = 0.008, 
+                 noResponseLatency = 0.001, jitter = 0.0, dropAfter = None, 
+                 resetOnDisconnect = True):
+        self.name = name
+        self.address = address
+        self.latency = latency
+        self.noResponseLatency = noResponseLatency
+        self.jitter = jitter
+        self.dropAfter = dropAfter
+        self.resetOnDisconnect = resetOnDisconnect
+        self.available = True
+        self.client = None
+        self.services = SimulatedServices()
+        self.reset()
+        self.writes = 0
+        self.crcErrors = 0
+        self.unknown = 0
+        self.disconnects = 0
+        self.fired = 0
+
+    def reset(self):
+        self.groups = {}
+        self.beep = None
+        self.light = None
+        self.initialized = False
+
+    def receive(self, data):
+        self.writes += 1
+        if data[:1] == b'\xf0':
+            if len(data) < 3 or godox.crc8(data[:-1]) != data[-1]:
+                self.crcErrors += 1
+                ERROR(f'Simulator: bad CRC {data.hex()}')
+            elif data[1] == 0xA1 and len(data) == 11:
+                mode = data[4]
+                lvl = data[5] if mode == godox.MODES['M'] else \
+                      data[9] if mode == godox.MODES['T'] else 0
+                self.groups[data[3]] = (mode, lvl)
+            elif data[1] == 0xA0 and len(data) == 14:
+                self.beep = bool(data[4])
+                self.light = bool(data[5])
+            else:
+                self.unknown += 1
+        elif data == INIT_COMMAND:
+            self.initialized = True
+        elif data.endswith(b',Test'):
+            self.fired += 1
+        else:
+            self.unknown += 1
+        VERBOSE(f'Simulator: {data.hex()}')
+
+    def state(self):
+        return {'groups': dict(self.groups), 'beep': self.beep, 'light': self.light}
+
+    def drop(self):
+        # Link loss as seen by the central: callback comes from the loop like in bleak
+        client = self.client
+        self.client = None
+        self.disconnects += 1
+        if self.resetOnDisconnect:
+            self.reset()
+        if client:
+            client.dropped()
+
+
+class SimulatedClient:
+    # Same interface as the BleakClient methods GodoxWorker calls
+    def __init__(self, trigger, target, disconnected = None, services = None, timeout = 3.0):
+        self.trigger = trigger
+        self.target = target
+        self.disconnected = disconnected
+        self.timeout = timeout
+        self.address = trigger.address
+        self.services = trigger.services
+        self.connected = False
+        self.loop = None
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        address = getattr(self.target, 'address', self.target)
+        await asyncio.sleep(self.trigger.latency)
+        if not self.trigger.available or address != self.trigger.address:
+            raise TimeoutError(f'Simulator: {address} not available')
+        self.connected = True
+        self.loop = asyncio.get_running_loop()
+        self.trigger.client = self
+
+    async def disconnect(self):
+        self.connected = False
+        if self.trigger.client is self:
+            self.trigger.client = None
+
+    def dropped(self):
+        self.connected = False
+        if self.disconnected:
+            self.loop.call_soon_threadsafe(self.disconnected, self)
+
+    async def write_gatt_char(self, char, data, response = True):
+        if not self.connected:
+            raise ConnectionError('Simulator: not connected')
+        t = self.trigger.latency if response else self.trigger.noResponseLatency
+        await asyncio.sleep(t + random.uniform(0.0, self.trigger.jitter))
+        if not self.connected:
+            raise ConnectionError('Simulator: disconnected during write')
+        self.trigger.receive(bytes(data))
+        if self.trigger.dropAfter and self.trigger.writes >= self.trigger.dropAfter:
+            self.trigger.dropAfter = None
+            self.trigger.drop()
+
+
+class SimulatedTransport:
+    def __init__(self, trigger = None):
+        self.trigger = trigger if trigger else SimulatedTrigger()
+
+    async def scan(self, matches, timeout):
+        await asyncio.sleep(self.trigger.latency)
+        if not self.trigger.available:
+            return None
+        device = SimpleNamespace(name = self.trigger.name, address = self.trigger.address)
+        adv = SimpleNamespace(local_name = self.trigger.name)
+        return device if matches(device, adv) else None
+
+    def client(self, target, disconnected, services = None, timeout = 3.0):
+        return SimulatedClient(self.trigger, target, disconnected, services, timeout)
+
+
+def expected(values):
+    return {godox.GROUPS[v[meta.ID]]: (godox.MODES[v[meta.MODE][0]], 
+                                       godox.level(v[meta.MODE][0], v[meta.POWER])) 
+            for v in values}
+
+def benchmark(rounds = 200, groups = 6, delay = 0.008, jitter = 0.002):
+    # Whole control path (Godox thread, coalescing, frames, transport) against the simulator
+    trigger = SimulatedTrigger(latency = delay, jitter = jitter)
+    device = godox.Godox(transport = SimulatedTransport(trigger))
+    device.worker.backoffMin = 0.05
+    links = []
+    device.callback('link', links.append)
+    try:
+        if not device.connect({}).result(timeout = 5.0):
+            print('Unable to connect to simulator')
+            return False
+        values = [{meta.ID: chr(ord('A') + i), meta.MODE: 'M', meta.POWER: '1/1'} 
+                  for i in range(groups)]
+        device.setValues(values).result(timeout = 5.0)
+        device.setBeepAndLight(True, False).result(timeout = 5.0)
+        device.test().result(timeout = 5.0)
+
+        durations = []
+        start = time.perf_counter()
+        for r in range(rounds):
+            v = values[r % groups]
+            v[meta.POWER] = str(1.0 + (r % 90) / 10)
+            t = latency.now()
+            device.setValues([{meta.ID: v[meta.ID], meta.POWER: v[meta.POWER]}], t).result(timeout = 5.0)
+            durations.append(time.perf_counter() - t)
+        total = time.perf_counter() - start
+        durations.sort()
+        ok = trigger.state()['groups'] == expected(values)
+        print(f'{rounds} updates: p50 {durations[len(durations) // 2] * 1000:.2f} ms, '
+              f'p99 {durations[int(len(durations) * 0.99)] * 1000:.2f} ms, '
+              f'{rounds / total:.0f} updates/s, {trigger.writes} writes, state ok: {ok}')
+
+        # Burst without waiting, only the latest values need to reach the trigger
+        writes = trigger.writes
+        futures = []
+        start = time.perf_counter()
+        for r in range(rounds):
+            v = values[r % groups]
+            v[meta.POWER] = str(1.0 + ((r + 7) % 90) / 10)
+            futures.append(device.setValues([{meta.ID: v[meta.ID], meta.POWER: v[meta.POWER]}]))
+        for f in futures:
+            f.result(timeout = 5.0)
+        burstOk = trigger.state()['groups'] == expected(values)
+        print(f'{rounds} burst updates: {(time.perf_counter() - start) * 1000:.1f} ms, '
+              f'{trigger.writes - writes} writes, state ok: {burstOk}')
+
+        # Link loss, state must be restored after reconnect
+        start = time.perf_counter()
+        trigger.drop()
+        values[0][meta.POWER] = '1/4'
+        device.setValues(values)
+        while links[-1:] != ['connected'] and time.perf_counter() - start < 10.0:
+            time.sleep(0.01)
+        state = trigger.state()
+        restored = state['groups'] == expected(values) and state['beep'] and not state['light']
+        print(f'reconnect: {(time.perf_counter() - start) * 1000:.0f} ms, links {links}, '
+              f'state restored: {restored}')
+        for line in latency.tracker.lines():
+            print(f'  {line}')
+        for line in device.metrics().result(timeout = 5.0):
+            print(f'  {line}')
+        print(f'crc errors {trigger.crcErrors}, unknown frames {trigger.unknown}, '
+              f'fired {trigger.fired}')
+        return ok and burstOk and restored and trigger.crcErrors == 0 and trigger.unknown == 0
+    finally:
+        device.stop()
+
+def main():
+    import sys
+    sys.exit(0 if benchmark() else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#**************************************************************************
+#
+#   Copyright (c) 2025 by Petri Damstén <petri.damsten@gmail.com>
+#                         https://petridamsten.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the
+#   Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#**************************************************************************
+
+import time
+from threading import Lock
+
+# Stages of a flash command after its origin (key press, nano event, wheel)
+STAGES = ('enqueue', 'dequeue', 'frame', 'write')
+SUB_BITS = 5 # 16 sub buckets per power of two above 32 us, ~6% resolution
+
+def now():
+    return time.perf_counter()
+
+def bucket(us):
+    # Linear below 2^SUB_BITS, then 16 buckets for each power of two like HdrHistogram
+    if us < (1 << SUB_BITS):
+        return us
+    shift = us.bit_length() - SUB_BITS
+    return (shift << (SUB_BITS - 1)) + (us >> shift)
+
+def bucketValue(index):
+    if index < (1 << SUB_BITS):
+        return index
+    shift = (index >> (SUB_BITS - 1)) - 1
+    sub = index - (shift << (SUB_BITS - 1))
+    return (sub << shift) + ((1 << shift) >> 1)
+
+
+class Histogram:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, seconds):
+        us = max(int(seconds * 1000000), 0)
+        i = bucket(us)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        # Seconds
+        if not self.count:
+            return 0.0
+        limit = max(1, round(self.count * p / 100.0))
+        n = 0
+        for i in sorted(self.counts):
+            n += self.counts[i]
+            if n >= limit:
+                return min(bucketValue(i), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+
+class LatencyTracker:
+    def __init__(self, stages = STAGES):
+        self.lock = Lock()
+        self.stages = stages
+        self.histograms = {stage: Histogram() for stage in stages}
+
+    def record(self, stage, origin, t = None):
+        if origin is None:
+            return
+        t = now() if t is None else t
+        with self.lock:
+            self.histograms[stage].record(t - origin)
+
+    def reset(self):
+        with self.lock:
+            for h in self.histograms.values():
+                h.reset()
+
+    def summary(self):
+        # {stage: (count, p50, p99, max)} in seconds
+        with self.lock:
+            return {stage: (h.count, h.percentile(50), h.percentile(99), h.max / 1000000.0) 
+                    for stage, h in self.histograms.items()}
+
+    def lines(self):
+        return [f'{stage}: n={n} p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, '
+                f'max {mx * 1000:.1f} ms' for stage, (n, p50, p99, mx) in self.summary().items()]
+
+    def dump(self, log = print):
+        for line in self.lines():
+            log(f'Latency {line}')
+
+tracker = LatencyTracker()
+
+def record(stage, origin, t = None):
+    tracker.record(stage, origin, t)
+
+def main():
+    import random
+
+    h = Histogram()
+    values = [random.lognormvariate(-6.0, 1.0) for _ in range(100000)]
+    start = time.perf_counter()
+    for v in values:
+        h.record(v)
+    took = time.perf_counter() - start
+    values.sort()
+    print(f'record: {took / len(values) * 1000000000:.0f} ns')
+    for p in [50, 90, 99, 99.9]:
+        exact = values[int(len(values) * p / 100.0)]
+        print(f'p{p}: {h.percentile(p) * 1000:.3f} ms (exact {exact * 1000:.3f} ms)')
+
+if __name__ == '__main__':
+    main()
@@ -24,11 +24,22 @@
 #**************************************************************************
 
 import os
+import time
+import json
+import fnmatch
+import hashlib
+from bisect import bisect_right
+from collections import namedtuple
+from copy import deepcopy
+from queue import Queue, Empty
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 import lib.exiftool as exiftool
+import lib.xmp as xmp
+import lib.exif as exif
 import lib.util as util
-from threading import Lock
+from threading import Lock, Thread, Event
+from lib.logger import INFO, ERROR, EXCEPTION, DEBUG, VERBOSE
 
 PREFIX =         "XMP:XMP-pdplus:"
 STAND =          PREFIX + "Stand"
@@ -48,6 +59,50 @@ POWER =          "Power"
 GEL =            "Gel"
 MODE =           "Mode"
 
+JOURNAL = util.path('user/session-journal.jsonl')
+INDEX = util.path('user/tethering-index.json')
+JOURNAL_AGE = 7 * 24 * 3600 # Seconds of settings history kept
+
+Snapshot = namedtuple('Snapshot', ['time', 'data', 'key'])
+
+def payloadKey(data):
+    # Content address of the payload, equal settings give equal keys
+    canonical = json.dumps(data, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def snapshot(data, t):
+    return Snapshot(t, data, payloadKey(data))
+
+def captureTime(fname):
+    # Returns (epoch seconds in camera clock, camera serial) or (None, None)
+    tags = exif.read(fname)
+    if not tags or not tags.get('DateTimeOriginal'):
+        tags = exiftool.readTags(fname, ['DateTimeOriginal', 'SubSecTimeOriginal', 'SerialNumber'])
+    if not tags or not tags.get('DateTimeOriginal'):
+        return None, None
+    try:
+        t = time.mktime(time.strptime(str(tags['DateTimeOriginal'])[:19], '%Y:%m:%d %H:%M:%S'))
+    except ValueError:
+        return None, None
+    subsec = str(tags.get('SubSecTimeOriginal', ''))
+    if subsec.isdigit():
+        t += float('0.' + subsec)
+    return t, str(tags.get('SerialNumber') or '')
+
+def writeSidecars(fnames, data, key = None):
+    # Existing sidecars (e.g. from tethering software) are merged by exiftool, 
+    # returns {fname: error or None}
+    result = {}
+    merge = []
+    for fname in fnames:
+        if xmp.supported(data) and not os.path.exists(fname):
+            result[fname] = xmp.write(fname, data, key)
+        else:
+            merge.append(fname)
+    if merge:
+        result.update(exiftool.writeMany(merge, data, key = key))
+    return result
+
 class RAWEventHandler(PatternMatchingEventHandler):
     def __init__(self, watcher, pattern):
         super(RAWEventHandler, self).__init__(    
@@ -56,22 +111,343 @@ class RAWEventHandler(PatternMatchingEventHandler):
             ignore_directories = True
         )
         self.watcher = watcher
+        self.rawPatterns = [p.lower() for p in pattern.split(';')]
         
     def on_created(self, event):
-        flash_info = os.path.splitext(event.src_path)[0] + '.json'
-        xmp = os.path.splitext(event.src_path)[0] + '.xmp'
-        util.writeJson(flash_info, self.watcher.json)
-        msg = exiftool.write(xmp, flash_info)
-        if not msg:
-            msg = (f'Metadata added: {os.path.basename(event.src_path)}', 0)
+        self.watcher.stability.seen(event.src_path)
+
+    def on_modified(self, event):
+        self.watcher.stability.seen(event.src_path)
+
+    def on_moved(self, event):
+        # Tethering software often writes to a temp name and renames when done
+        self.watcher.stability.forget(event.src_path)
+        name = os.path.basename(event.dest_path).lower()
+        if any(fnmatch.fnmatchcase(name, p) for p in self.rawPatterns):
+            self.watcher.stability.seen(event.dest_path)
+
+PREVIEW_EXTENSIONS = ['.jpg', '.jpeg', '.heif', '.heic', '.tif', '.tiff']
+
+def captureGroup(fnames):
+    # RAW files first, they are the best source for the capture time
+    return sorted(fnames, key = lambda f: os.path.splitext(f)[1].lower() in PREVIEW_EXTENSIONS)
+
+class StabilityTracker:
+    # Files are handed over only after size and mtime have not changed for settle seconds.
+    # Files with the same name in the same folder (RAW+JPEG) ready within window are one capture,
+    # same names from different folders (e.g. one per camera) are kept apart.
+    def __init__(self, watcher, settle = 0.3, window = 0.5, interval = 0.1):
+        self.watcher = watcher
+        self.settle = settle
+        self.window = window
+        self.interval = interval
+        self.pending = {}
+        self.groups = {}
+        self.lock = Lock()
+        self.stopping = Event()
+        self.thread = Thread(target = self.loop, daemon = True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.flush(True)
+
+    def seen(self, fname):
+        now = time.time()
+        with self.lock:
+            if fname in self.pending:
+                self.pending[fname][3] = now
+            else:
+                # [arrival, size, mtime, last change]
+                self.pending[fname] = [now, -1, -1, now]
+
+    def forget(self, fname):
+        with self.lock:
+            self.pending.pop(fname, None)
+
+    def loop(self):
+        while not self.stopping.wait(self.interval):
+            with self.lock:
+                items = list(self.pending.items())
+            now = time.time()
+            for fname, state in items:
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    self.forget(fname)
+                    continue
+                if st.st_size != state[1] or st.st_mtime_ns != state[2]:
+                    state[1:4] = [st.st_size, st.st_mtime_ns, now]
+                elif st.st_size > 0 and now - state[3] >= self.settle:
+                    self.forget(fname)
+                    self.group(fname, state[0], now)
+            self.flush()
+
+    def group(self, fname, arrival, now):
+        key = os.path.splitext(fname)[0].lower()
+        if key in self.groups:
+            group = self.groups[key]
+            group[1] = min(group[1], arrival)
+            group[2].append(fname)
         else:
-            msg = (f'Metadata FAILED: {os.path.basename(event.src_path)}', 1)
-        self.watcher.msg(msg)
+            # [first ready, arrival, files]
+            self.groups[key] = [now, arrival, [fname]]
+
+    def flush(self, all = False):
+        now = time.time()
+        for key, (ready, arrival, fnames) in list(self.groups.items()):
+            if all or now - ready >= self.window:
+                del self.groups[key]
+                self.watcher.enqueue(captureGroup(fnames), arrival)
+
+class SettingsHistory:
+    # Copy-on-write buffer: writers replace the whole tuple so readers never need a lock.
+    # Snapshots older than age seconds are dropped, the latest one is always kept.
+    def __init__(self, age = JOURNAL_AGE, journal = None):
+        self.age = age
+        self.snapshots = ()
+        self.lock = Lock()
+        self.journal = journal
+        if journal:
+            self.load()
+
+    def prune(self, snapshots):
+        cutoff = time.time() - self.age
+        i = bisect_right(snapshots, cutoff, key = lambda s: s.time)
+        return snapshots[min(i, len(snapshots) - 1):]
+
+    def load(self):
+        try:
+            with open(self.journal, 'r') as f:
+                lines = f.read().splitlines()
+            self.snapshots = self.prune(tuple(snapshot(d['data'], d['time']) 
+                                              for d in (json.loads(line) for line in lines)))
+            with open(self.journal, 'w') as f:
+                f.write(''.join(json.dumps({'time': s.time, 'data': s.data}) + '\n' 
+                                for s in self.snapshots))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            EXCEPTION(f'Reading session journal {self.journal} failed')
+
+    def record(self, data, t = None):
+        s = snapshot(deepcopy(data), t if t else time.time())
+        with self.lock:
+            if self.snapshots and self.snapshots[-1].key == s.key:
+                return
+            self.snapshots = self.prune(self.snapshots + (s,))
+            if self.journal:
+                try:
+                    with open(self.journal, 'a') as f:
+                        f.write(json.dumps({'time': s.time, 'data': s.data}) + '\n')
+                except OSError:
+                    EXCEPTION(f'Writing session journal {self.journal} failed')
+
+    def latest(self):
+        snapshots = self.snapshots
+        return snapshots[-1].data if snapshots else {}
+
+    def since(self):
+        snapshots = self.snapshots
+        return snapshots[0].time if snapshots else None
+
+    def at(self, t):
+        # None when t is before the earliest snapshot, settings at that time are not known
+        snapshots = self.snapshots
+        i = bisect_right(snapshots, t, key = lambda s: s.time) - 1
+        return snapshots[i] if i >= 0 else None
+
+class TetheringIndex:
+    # Persisted per folder listing, folders whose mtime has not changed are not listed again.
+    # lastRun is the last time the watcher was known to be running.
+    # {'version': 2, 'lastRun': t, 'folders': {folder: {'mtime': ns, 'dirs': [...], 
+    #                                                   'pending': {name: mtime_ns}}}}
+    VERSION = 2
+
+    def __init__(self, fname, pattern):
+        self.fname = fname
+        self.patterns = [p.lower() for p in pattern.split(';')]
+        self.folders = {}
+        self.lastRun = None
+        try:
+            with open(fname, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.folders = data['folders']
+                self.lastRun = data['lastRun']
+        except FileNotFoundError:
+            pass
+        except Exception:
+            EXCEPTION(f'Reading tethering index {fname} failed')
+
+    def save(self, lastRun):
+        data = {'version': self.VERSION, 'lastRun': lastRun, 'folders': self.folders}
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators = (',', ':'))
+        os.replace(tmp, self.fname)
+
+    def matches(self, name):
+        name = name.lower()
+        return any(fnmatch.fnmatchcase(name, p) for p in self.patterns)
+
+    def scan(self, folder):
+        # Returns [(fname, mtime_ns)] of files without a sidecar
+        pending = []
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                self.folders.pop(folder, None)
+                continue
+            entry = self.folders.get(folder)
+            if not entry or entry['mtime'] != mtime:
+                entry = self.list(folder, mtime)
+                self.folders[folder] = entry
+            stack.extend(entry['dirs'])
+            pending.extend((os.path.join(folder, name), t) for name, t in entry['pending'].items())
+        return pending
+
+    def list(self, folder, mtime):
+        entry = {'mtime': mtime, 'dirs': [], 'pending': {}}
+        names = set()
+        raws = []
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks = False):
+                    entry['dirs'].append(e.path)
+                else:
+                    names.add(e.name.lower())
+                    if self.matches(e.name):
+                        raws.append(e)
+        for e in raws:
+            stem = os.path.splitext(e.name)[0].lower()
+            if stem + '.xmp' not in names and stem + '.json' not in names:
+                entry['pending'][e.name] = e.stat().st_mtime_ns
+        return entry
+
+class MetadataPipeline:
+    def __init__(self, watcher, workers = 2, size = 64, retries = 3, backoff = 0.2, 
+                 batchWindow = 0.05, batchSize = 16):
+        self.watcher = watcher
+        self.queue = Queue(maxsize = size)
+        self.workers = [Thread(target = self.work, daemon = True) for _ in range(max(1, workers))]
+        self.retries = retries
+        self.backoff = backoff
+        self.batchWindow = batchWindow
+        self.batchSize = max(1, batchSize)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def submit(self, fnames, arrival):
+        # Files of one capture are submitted together.
+        # Blocks the caller when the queue is full (back-pressure)
+        self.queue.put((fnames, arrival))
+        self.watcher.queueChanged(self.depth())
+
+    def resolve(self, item):
+        fnames, arrival = item
+        settings = self.watcher.settingsFor(fnames[0], arrival)
+        if settings is None:
+            # Captured before the earliest remembered settings, better no metadata than wrong
+            self.watcher.msg((f'Metadata skipped: {os.path.basename(fnames[0])}', 1))
+            self.watcher.queueChanged(self.depth())
+            return None
+        return (fnames, settings)
+
+    def work(self):
+        carry = None
+        while True:
+            if carry is None:
+                item = self.queue.get()
+                if item is None:
+                    return
+                carry = self.resolve(item)
+                if carry is None:
+                    continue
+            # Collect files with identical settings arriving within the batch window
+            batch = [carry]
+            carry = None
+            quit = False
+            deadline = time.monotonic() + self.batchWindow
+            while len(batch) < self.batchSize:
+                try:
+                    item = self.queue.get(timeout = max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is None:
+                    quit = True
+                    break
+                item = self.resolve(item)
+                if item is None:
+                    continue
+                if item[1].key != batch[0][1].key:
+                    carry = item
+                    break
+                batch.append(item)
+            self.processBatch(batch)
+            if quit:
+                if carry:
+                    self.processBatch([carry])
+                return
+
+    def processBatch(self, batch):
+        fnames = [fname for fnames, _ in batch for fname in fnames]
+        try:
+            self.process(fnames, batch[0][1])
+        except Exception:
+            EXCEPTION(f'Processing {fnames} failed')
+        self.watcher.queueChanged(self.depth())
+
+    def process(self, fnames, settings):
+        sidecars = {}
+        for fname in fnames:
+            sidecars.setdefault(os.path.splitext(fname)[0] + '.xmp', fname)
+        pending = list(sidecars.keys())
+        for attempt in range(self.retries + 1):
+            result = writeSidecars(pending, settings.data, settings.key)
+            for sidecar, err in result.items():
+                if not err:
+                    self.watcher.msg((f'Metadata added: {os.path.basename(sidecars[sidecar])}', 0))
+            pending = [sidecar for sidecar, err in result.items() if err]
+            if not pending:
+                return
+            DEBUG(f'Attempt {attempt + 1} failed:', {k: v for k, v in result.items() if v})
+            if attempt < self.retries:
+                time.sleep(self.backoff * (2 ** attempt))
+        for sidecar in pending:
+            ERROR(result[sidecar])
+            self.watcher.msg((f'Metadata FAILED: {os.path.basename(sidecars[sidecar])}', 1))
 
 class RAWWatcher:
     def __init__(self):
         self.observer = None
-        self.lock = Lock()
+        self.pipeline = None
+        self.catchUp = None
+        self.index = None
+        self.stability = None
+        self.processed = set()
+        self.processedLock = Lock()
+        self.indexLock = Lock()
+        self.stopping = False
+        self.history = SettingsHistory(journal = JOURNAL)
+        self.offsets = {}
         self.callbacks = {}
 
     def callback(self, name, callback):
@@ -81,21 +457,96 @@ class RAWWatcher:
         if 'msg' in self.callbacks:
             self.callbacks['msg'](s)
 
-    def start(self, folder, pattern):
+    def queueChanged(self, depth):
+        if 'queue' in self.callbacks:
+            self.callbacks['queue'](depth)
+
+    def start(self, folder, pattern, workers = 2, queueSize = 64, catchUp = True, settle = 0.3, 
+              batchWindow = 0.05, batchSize = 16, groupWindow = 0.5):
+        exiftool.setEngines(workers)
+        self.pipeline = MetadataPipeline(self, workers, queueSize, batchWindow = batchWindow, 
+                                         batchSize = batchSize)
+        self.pipeline.start()
+        self.stability = StabilityTracker(self, settle, groupWindow)
+        self.stability.start()
         self.observer = Observer()
         event_handler = RAWEventHandler(self, pattern)
         self.observer.schedule(event_handler, folder, recursive = True)
         self.observer.start()
+        self.index = TetheringIndex(INDEX, pattern)
+        if catchUp:
+            self.catchUp = Thread(target = self.processMissing, args = (folder, pattern), 
+                                  daemon = True)
+            self.catchUp.start()
+
+    def saveIndex(self):
+        with self.indexLock:
+            try:
+                self.index.save(time.time())
+            except OSError:
+                EXCEPTION(f'Writing tethering index {INDEX} failed')
+
+    def processMissing(self, folder, pattern):
+        # Files that arrived while we were not running. Older files were either handled by 
+        # the previous run or shot with settings we do not know, both are left alone.
+        t = time.perf_counter()
+        since = max(self.index.lastRun or 0.0, self.history.since() or time.time())
+        with self.indexLock:
+            pending = self.index.scan(os.path.abspath(folder))
+        self.saveIndex()
+        pending = [(fname, mtime / 1e9) for fname, mtime in pending if mtime / 1e9 >= since]
+        DEBUG(f'Tethering folder scanned in {time.perf_counter() - t:.3f}s, '
+              f'{len(pending)} files without metadata since {time.ctime(since)}')
+        groups = {}
+        for fname, mtime in pending:
+            key = os.path.splitext(fname)[0].lower()
+            groups.setdefault(key, []).append((fname, mtime))
+        for files in groups.values():
+            if self.stopping:
+                return
+            files = [(f, t) for f, t in files 
+                     if not os.path.exists(os.path.splitext(f)[0] + '.xmp')]
+            if files:
+                self.enqueue(captureGroup([f for f, _ in files]), min(t for _, t in files))
+
+    def enqueue(self, fnames, arrival):
+        # Each basename is processed only once, later events for it are duplicates
+        with self.processedLock:
+            new = []
+            for fname in fnames:
+                key = os.path.splitext(fname)[0]
+                if key in self.processed:
+                    VERBOSE(f'Already processed: {fname}')
+                else:
+                    self.processed.add(key)
+                    new.append(fname)
+        if new:
+            self.pipeline.submit(new, arrival)
     
     def stop(self):
+        self.stopping = True
         self.observer.stop()
         self.observer.join()
+        self.stability.stop()
+        if self.catchUp:
+            self.catchUp.join()
+        self.pipeline.stop()
+        self.saveIndex()
+        exiftool.stop()
 
     def json(self):
-        with self.lock:
-            j = self.json
-        return j
+        return self.history.latest()
 
     def setJson(self, json):
-        with self.lock:
-            self.json = json
+        self.history.record(json)
+
+    def settingsFor(self, fname, arrival):
+        # Camera and computer clocks differ, smallest (arrival - capture) seen per camera is 
+        # the best estimate for the offset between them.
+        capture, serial = captureTime(fname)
+        if capture is None:
+            return self.history.at(arrival)
+        offset = min(self.offsets.get(serial, arrival - capture), arrival - capture)
+        self.offsets[serial] = offset
+        VERBOSE(f'{os.path.basename(fname)}: capture {capture}, clock offset {offset:.3f}')
+        return self.history.at(capture + offset)
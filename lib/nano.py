@@ -23,9 +23,12 @@
 #
 #**************************************************************************
 
+import os
 from os import environ
+import time
+import json
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
 
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 import pygame.midi
@@ -34,61 +37,41 @@ import lib.metadata as meta
 from lib.logger import INFO, ERROR, EXCEPTION, DEBUG, VERBOSE
 
 CC = 176
+READ_SIZE = 256
 KEYDOWN = 127
 KEYUP = 0
-KEYS = {
-    58: 'TRACK_PREV',
-    59: 'TRACK_NEXT',
-    46: 'CYCLE',
-    60: 'MARKER_SET',
-    61: 'MARKER_PREV',
-    62: 'MARKER_NEXT',
-    43: 'PREV',
-    44: 'NEXT',
-    42: 'STOP',
-    41: 'PLAY',
-    45: 'RECORD',
-    32: ('A', 'SOLO'),
-    33: ('B', 'SOLO'),
-    34: ('C', 'SOLO'),
-    35: ('D', 'SOLO'),
-    36: ('E', 'SOLO'),
-    37: ('F', 'SOLO'),
-    38: ('G', 'SOLO'),
-    39: ('H', 'SOLO'),
-    48: ('A', 'MUTE'),
-    49: ('B', 'MUTE'),
-    50: ('C', 'MUTE'),
-    51: ('D', 'MUTE'),
-    52: ('E', 'MUTE'),
-    53: ('F', 'MUTE'),
-    54: ('G', 'MUTE'),
-    55: ('H', 'MUTE'),
-    64: ('A', 'RECORD'),
-    65: ('B', 'RECORD'),
-    66: ('C', 'RECORD'),
-    67: ('D', 'RECORD'),
-    68: ('E', 'RECORD'),
-    69: ('F', 'RECORD'),
-    70: ('G', 'RECORD'),
-    71: ('H', 'RECORD'),
-    0: ('A', 'SLIDER'),
-    1: ('B', 'SLIDER'),
-    2: ('C', 'SLIDER'),
-    3: ('D', 'SLIDER'),
-    4: ('E', 'SLIDER'),
-    5: ('F', 'SLIDER'),
-    6: ('G', 'SLIDER'),
-    7: ('H', 'SLIDER'),
-    16: ('A', 'KNOB'),
-    17: ('B', 'KNOB'),
-    18: ('C', 'KNOB'),
-    19: ('D', 'KNOB'),
-    20: ('E', 'KNOB'),
-    21: ('F', 'KNOB'),
-    22: ('G', 'KNOB'),
-    23: ('H', 'KNOB'),
-}
+PROFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controllers')
+DEFAULT_PROFILE = 'nanoKONTROL2'
+
+def loadProfiles(folder = PROFILES):
+    # Controller layouts: {name: profile}, see controllers/nanoKONTROL2.json
+    profiles = {}
+    for fname in sorted(os.listdir(folder)):
+        if fname.endswith('.json'):
+            try:
+                with open(os.path.join(folder, fname)) as f:
+                    profile = json.load(f)
+                profiles[profile['name']] = profile
+            except Exception as e:
+                ERROR(f'Invalid controller profile {fname}: {e}')
+    return profiles
+
+def compileProfile(profile):
+    # 16 channels x 128 controllers of (key, continuous) or None. Key is the control name or
+    # (group, name) as sent in 'event' messages. Channel null means any channel.
+    table = [None] * 128
+    continuous = set(profile.get('continuous', []))
+    for name, v in profile['controls'].items():
+        if isinstance(v, dict):
+            for control, cc in v.items():
+                table[cc] = ((name, control), control in continuous)
+        else:
+            table[v] = (name, name in continuous)
+    channel = profile.get('channel')
+    if channel is None:
+        return [table] * 16
+    return [table if ch == channel else [None] * 128 for ch in range(16)]
+
 
 class NanoKontrol2:
     def __init__(self):
@@ -138,15 +121,27 @@ class NanoKontrol2:
 
 
 class NanoKontrol2Worker(Thread):
-    def __init__(self, inQueue, outQueue):
+    def __init__(self, inQueue, outQueue, activeInterval = 0.002, idleInterval = 0.01, 
+                 idleAfter = 1.0):
         super().__init__()
         self.inQueue = inQueue
         self.outQueue = outQueue
+        self.activeInterval = activeInterval
+        self.idleInterval = idleInterval
+        self.idleAfter = idleAfter
+        self.lastEvent = 0.0
+        self.merged = 0
 
         self.midi_in = None
         self.input_id = -1
 
+        self.midi_out = None
         self.output_id = -1
+        self.leds = {} # Shadow copy of the controller LEDs, cc -> value
+        self.profiles = {}
+        self.profile = None
+        self.controls = {}
+        self.dispatch = None
 
         self.directCallback = None
     
@@ -155,69 +150,105 @@ class NanoKontrol2Worker(Thread):
             self.outQueue.put((cmd, data))
 
     def setValues(self, values):
-        a = []
-        t = 0
-        for ch in range(8):
-            gid = chr(ord('A') + ch)
-            v = 127 if ch < len(values) and values[ch][meta.MODE] != '-' else 0
-            a.append([[CC, self.invertedKeys[gid]['SOLO'], v], t]) 
-            t += 10
-            v = 127 if ch < len(values) and values[ch][meta.MODE] == 'M' else 0
-            a.append([[CC, self.invertedKeys[gid]['MUTE'], v], t]) 
-            t += 10
-        self.setLights(a) 
+        # Values are the changed fields per group, only mode changes show in the lights
+        leds = {}
+        for flash in values:
+            gid = flash[meta.ID]
+            if meta.MODE not in flash or gid not in self.controls:
+                continue
+            leds[self.controls[gid].get('SOLO')] = 127 if flash[meta.MODE] != '-' else 0
+            leds[self.controls[gid].get('MUTE')] = 127 if flash[meta.MODE] == 'M' else 0
+        self.setLights(leds)
 
     def connect(self):
+        # PortMidi lists devices at init, start over to see newly plugged controllers
+        self.closePorts()
+        if pygame.midi.get_init():
+            pygame.midi.quit()
         pygame.midi.init()
 
+        self.input_id = -1
+        self.output_id = -1
+        self.profile = None
         for i in range(pygame.midi.get_count()):
             info = pygame.midi.get_device_info(i)
             (_, name, input_dev, output_dev, _) = info
             name = name.decode()
             DEBUG(f"{i}: {name} (input={bool(input_dev)}, output={bool(output_dev)})")
-            if "nanoKONTROL2" in name and bool(input_dev):
-                self.input_id = i
-            if "nanoKONTROL2" in name and bool(output_dev):
-                self.output_id = i
-
-        pygame.midi.quit()
+            for profile in self.profiles.values():
+                if self.profile not in [None, profile] or profile['match'] not in name:
+                    continue
+                self.useProfile(profile)
+                if bool(input_dev):
+                    self.input_id = i
+                if bool(output_dev):
+                    self.output_id = i
 
         if self.output_id != -1 and self.input_id != -1:
             self.sendMsg('connected')
         else:
+            self.useProfile(self.profiles[DEFAULT_PROFILE])
             self.sendMsg('failed')
 
-    def setLights(self, a):
-        if self.output_id >= 0:
-            pygame.midi.init()
-            midi_out = pygame.midi.Output(self.output_id)
-
-            midi_out.write(a) 
+    def output(self):
+        # Output port stays open, it is reopened on next write if writing fails
+        if not self.midi_out and self.output_id >= 0:
+            if not pygame.midi.get_init():
+                pygame.midi.init()
+            self.midi_out = pygame.midi.Output(self.output_id)
+        return self.midi_out
+
+    def closeOutput(self):
+        # Controller state is unknown after this, next writes send everything
+        self.leds = {}
+        if self.midi_out:
+            try:
+                self.midi_out.close()
+            except Exception:
+                pass
+            self.midi_out = None
 
-            midi_out.close()
-            del midi_out
-            midi_out = None
-            pygame.midi.quit()
+    def closePorts(self):
+        self.closeOutput()
+        if self.midi_in:
+            try:
+                self.midi_in.close()
+            except Exception:
+                pass
+            self.midi_in = None
+
+    def setLights(self, leds):
+        # Only LEDs that differ from the shadow copy are sent, all in one write
+        changed = {cc: v for cc, v in leds.items() if cc is not None and self.leds.get(cc) != v}
+        if not changed:
+            return
+        a = [[[CC, cc, v], 0] for cc, v in changed.items()]
+        for attempt in range(2):
+            try:
+                if self.output():
+                    self.midi_out.write(a)
+                    self.leds.update(changed)
+                return
+            except Exception as e:
+                ERROR(f'MIDI write failed: {e}')
+                self.closeOutput()
 
     def resetLights(self):
-        a = []
-        def off(d, t):
-            for _, v in d.items():
-                t += 10
+        leds = {}
+        def off(d):
+            for v in d.values():
                 if isinstance(v, dict):
-                    t = off(v, t)
+                    off(v)
                 else:
-                    a.append([[CC, v, 0], t]) 
-            return t
-        t = off(self.invertedKeys, 0) + 10
-        a.append([[CC, self.invertedKeys['STOP'], 127], t]) 
-
-        self.setLights(a)
+                    leds[v] = 0
+        off(self.controls)
+        leds[self.controls.get('STOP')] = 127
+        self.leds = {}
+        self.setLights(leds)
 
     def stop(self):
-        if self.midi_in:
-            self.midi_in.close()
-            del self.midi_in
+        DEBUG(f'{self.merged} slider/knob events merged')
+        self.closePorts()
         if pygame.midi.get_init():
             pygame.midi.quit()
 
@@ -225,33 +256,78 @@ class NanoKontrol2Worker(Thread):
         self.sendMsg('event', (e, d))
 
     def setBeepAndLight(self, beep = True, light = True):
-        a = []
-        a.append([[CC, self.invertedKeys['PREV'], 127 if beep else 0], 0]) 
-        a.append([[CC, self.invertedKeys['RECORD'], 127 if light else 0], 0]) 
+        self.setLights({self.controls.get('PREV'): 127 if beep else 0,
+                        self.controls.get('RECORD'): 127 if light else 0})
 
-        self.setLights(a) 
+    def openInput(self):
+        if not pygame.midi.get_init():
+            pygame.midi.init()
+        try:
+            self.midi_in = pygame.midi.Input(self.input_id)
+        except Exception as e:
+            ERROR(f'Unable to open MIDI input: {e}')
+            self.input_id = -1
+
+    def timeout(self):
+        # PortMidi has nothing to select() on: without input block on commands, with input wait
+        # at most the poll interval, shorter while the controller is being used
+        if not self.midi_in:
+            return None
+        if time.monotonic() - self.lastEvent > self.idleAfter:
+            return self.idleInterval
+        return self.activeInterval
+
+    def readInput(self):
+        # Drains the port. Slider and knob moves between button events collapse to the last
+        # value per controller, so a fast sweep gives one update instead of dozens.
+        events = []
+        while self.midi_in.poll():
+            events.extend(self.midi_in.read(READ_SIZE))
+        moves = {}
+        dispatch = self.dispatch
+        for event in events:
+            data, _ = event
+            if data[0] & 0xF0 != CC:
+                continue
+            entry = dispatch[data[0] & 0x0F][data[1] & 0x7F]
+            if entry is None:
+                continue
+            key, continuous = entry
+            if continuous:
+                if key in moves:
+                    self.merged += 1
+                moves[key] = data[2]
+            else:
+                self.sendMoves(moves)
+                moves = {}
+                self.sendMsg('event', (key, data[2]))
+        self.sendMoves(moves)
+
+    def sendMoves(self, moves):
+        if self.directCallback:
+            for key, value in moves.items():
+                self.directCallback((key[0], value, key[1]))
+
+    def useProfile(self, profile):
+        # Compiled once per connect, the read loop only indexes the tables
+        if profile is not self.profile:
+            DEBUG(f'Controller profile: {profile["name"]}')
+            self.profile = profile
+            self.controls = profile['controls']
+            self.dispatch = compileProfile(profile)
 
     def loop(self):
         while True:
+            if self.input_id >= 0 and not self.midi_in:
+                self.openInput()
             try:
-                cmd = 'pass'
-                cmd, data = self.inQueue.get(block = False, timeout = 0.1)
+                cmd, data = self.inQueue.get(timeout = self.timeout())
                 VERBOSE(f'Command: {cmd}', data)
-            except:
-                if self.input_id >= 0:
-                    if not pygame.midi.get_init():
-                        pygame.midi.init()
-                        self.midi_in = pygame.midi.Input(self.input_id)
-                    if self.midi_in.poll():
-                        events = self.midi_in.read(10)
-                        for event in events:
-                            data, _ = event
-                            if (KEYS[data[1]][1] == 'SLIDER' or KEYS[data[1]][1] == 'KNOB'):
-                                if self.directCallback:
-                                    self.directCallback(
-                                        (KEYS[data[1]][0], data[2], KEYS[data[1]][1]))
-                            else:
-                                self.sendMsg('event', (KEYS[data[1]], data[2]))
+            except Empty:
+                cmd = 'pass'
+            if self.midi_in and self.midi_in.poll():
+                self.lastEvent = time.monotonic()
+                self.readInput()
 
             if cmd == 'connect':
                 self.directCallback = data
@@ -270,16 +346,74 @@ class NanoKontrol2Worker(Thread):
                 ERROR('Unknown command', cmd)
 
     def run(self):
-        self.invertedKeys = {}
-        for k, v in KEYS.items():
-            if isinstance(v, str):
-                self.invertedKeys[v] = k
-            else:
-                if v[0] not in self.invertedKeys:
-                    self.invertedKeys[v[0]] = {}
-                self.invertedKeys[v[0]][v[1]] = k
+        self.profiles = loadProfiles()
+        self.useProfile(self.profiles[DEFAULT_PROFILE])
 
         self.loop()
 
+class ReplayInput:
+    # pygame.midi.Input look-alike for benchmarking the worker without a controller
+    def __init__(self):
+        self.events = []
+
+    def poll(self):
+        return bool(self.events)
+
+    def read(self, n):
+        events, self.events = self.events[:n], self.events[n:]
+        return events
+
+    def close(self):
+        pass
+
+def benchmark(seconds = 2.0, events = 200):
+    import random
+
+    worker = NanoKontrol2Worker(Queue(), None)
+    worker.start()
+    time.sleep(0.1)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    idle = (time.process_time() - cpu) / (time.perf_counter() - start)
+    print(f'idle, no controller: {idle * 100:.1f}% cpu')
+
+    delays = []
+    sent = []
+    worker.directCallback = lambda d: delays.append(time.perf_counter() - sent[-1])
+    pygame.midi.init()
+    worker.midi_in = ReplayInput()
+    worker.inQueue.put(('pass', None))
+    cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    idle = (time.process_time() - cpu) / (time.perf_counter() - start)
+    print(f'idle, controller open: {idle * 100:.1f}% cpu')
+
+    for i in range(events):
+        # Pauses longer than idleAfter now and then to include idle polling latency
+        time.sleep(random.choice([0.005, 0.01, 0.02, 0.05]) if i % 20 else worker.idleAfter + 0.1)
+        sent.append(time.perf_counter())
+        worker.midi_in.events.append([[CC, 0, i % 128, 0], 0])
+    time.sleep(0.1)
+    delays.sort()
+    sweeps = []
+    worker.directCallback = sweeps.append
+    merged = worker.merged
+    # Fader sweep arriving faster than the worker polls
+    for i in range(500):
+        worker.midi_in.events.append([[CC, i % 2, i // 2 % 128, 0], 0])
+        if i % 100 == 99:
+            time.sleep(0.001)
+    time.sleep(0.1)
+    print(f'{len(delays)} events: latency p50 {delays[len(delays) // 2] * 1000:.2f} ms, '
+          f'p99 {delays[int(len(delays) * 0.99)] * 1000:.2f} ms, max {delays[-1] * 1000:.2f} ms')
+    print(f'500 event sweep: {len(sweeps)} updates, {worker.merged - merged} events merged')
+    worker.inQueue.put(('stop', None))
+    worker.join()
+
+def main():
+    benchmark()
+
 if __name__ == '__main__':
-    pass
+    main()
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#**************************************************************************
+#
+#   Copyright (c) 2025 by Petri Damstén <petri.damsten@gmail.com> 
+#                         https://petridamsten.com
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the
+#   Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#**************************************************************************
+
+import os
+import tempfile
+from xml.sax.saxutils import escape
+
+# Mirrors the pdplus schema in exiftool-custom-ns.config
+PREFIX = 'XMP:XMP-pdplus:'
+FLASHES = PREFIX + 'Flashes'
+FLASH_FIELDS = ['Role', 'Name', 'Modifier', 'Accessory', 'Power', 'Gel', 'Id', 'Mode']
+NAMESPACE = 'http://petridamsten.com/pdplus/1.0/'
+HEADER = (
+    "<?xpacket begin='\ufeff' id='W5M0MpCehiHzreSzNTczkc9d'?>\n"
+    "<x:xmpmeta xmlns:x='adobe:ns:meta/' x:xmptk='Flash Control'>\n"
+    "<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>\n"
+    "\n"
+    " <rdf:Description rdf:about=''\n"
+    f"  xmlns:pdplus='{NAMESPACE}'>\n"
+)
+FOOTER = (
+    " </rdf:Description>\n"
+    "</rdf:RDF>\n"
+    "</x:xmpmeta>\n"
+    "<?xpacket end='w'?>"
+)
+
+def supported(data):
+    # Only the fixed pdplus schema is serialized here, anything else goes to exiftool
+    return all(k.startswith(PREFIX) for k in data.keys())
+
+def text(v):
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return escape(str(v))
+
+_cache = {}
+CACHE_SIZE = 16
+
+def sidecar(data, key = None):
+    # key is a content hash of data, serialized bytes are reused while settings do not change
+    if key and key in _cache:
+        return _cache[key]
+    a = [HEADER]
+    for name, v in data.items():
+        tag = name[len(PREFIX):]
+        if name == FLASHES:
+            flashes = [f for f in v if any(f.get(k) not in (None, '') for k in FLASH_FIELDS)]
+            if not flashes:
+                continue
+            a.append(f'  <pdplus:{tag}>\n   <rdf:Seq>\n')
+            for f in flashes:
+                a.append("    <rdf:li rdf:parseType='Resource'>\n")
+                for k in FLASH_FIELDS:
+                    if f.get(k) not in (None, ''):
+                        a.append(f'     <pdplus:{k}>{text(f[k])}</pdplus:{k}>\n')
+                a.append('    </rdf:li>\n')
+            a.append(f'   </rdf:Seq>\n  </pdplus:{tag}>\n')
+        elif v not in (None, ''):
+            a.append(f'  <pdplus:{tag}>{text(v)}</pdplus:{tag}>\n')
+    a.append(FOOTER)
+    b = ''.join(a).encode('utf-8')
+    if key:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = b
+    return b
+
+def writeBytes(fname, b):
+    fd, tmp = tempfile.mkstemp(prefix = '.', suffix = '.tmp', dir = os.path.dirname(fname) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b)
+        os.replace(tmp, fname)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+def write(fname, data, key = None):
+    try:
+        writeBytes(fname, sidecar(data, key))
+    except Exception as e:
+        return f"XMP write failed: {e}"
+    return None
+
+def main():
+    import time
+
+    data = {
+        PREFIX + 'Stand': 'C-Stand',
+        PREFIX + 'Exposures': '1',
+        PREFIX + 'Filter': '',
+        FLASHES: [
+            {'Id': 'A', 'Mode': 'M', 'Power': '6.5', 'Name': 'AD200', 'Role': 'Key'},
+            {'Id': 'B', 'Mode': 'TTL', 'Power': '+0.3', 'Name': 'V1 <Fuji & co>'},
+        ],
+    }
+    print(sidecar(data).decode('utf-8'))
+    n = 10000
+    t = time.perf_counter()
+    for _ in range(n):
+        sidecar(data)
+    t = time.perf_counter() - t
+    print(f'{t / n * 1000000:.1f} us / sidecar')
+
+if __name__ == '__main__':
+    main()